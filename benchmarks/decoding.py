@@ -0,0 +1,75 @@
+"""
+Compares decoding fetched entities into rows using _make_result for
+each entity (djangotoolbox's way) and using a row decoder.
+"""
+import datetime
+import time
+
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from google.appengine.api.datastore_types import Key
+
+from ..db.decoders import get_row_decoder, DECODE_BATCH_SIZE
+from ..tests.testmodels import FieldsWithoutOptionsModel
+
+
+def make_entities(connection, count):
+    """
+    Returns property dicts for count FieldsWithoutOptionsModel rows, as
+    they would be stored in the datastore.
+    """
+    instance = FieldsWithoutOptionsModel(
+        datetime=datetime.datetime.now(), date=datetime.date.today(),
+        time=datetime.time(12, 30), floating_point=5.97, boolean=True,
+        null_boolean=False, text='Hallo', email='hallo@hallo.com',
+        comma_seperated_integer='5,4,3,2', ip_address='194.167.1.1',
+        slug='slug', url='http://www.scholardocs.com',
+        long_text=1000 * 'A', indexed_text='hello', integer=-400,
+        small_integer=-4, positive_integer=400, positive_small_integer=4)
+    opts = FieldsWithoutOptionsModel._meta
+    properties = {}
+    for field in opts.fields:
+        if not field.primary_key:
+            value = field.get_db_prep_save(getattr(instance, field.attname),
+                                           connection=connection)
+            properties[field.column] = connection.ops.value_for_db(value,
+                                                                   field)
+
+    entities = []
+    for id in xrange(1, count + 1):
+        entity = dict(properties)
+        entity[opts.pk.column] = Key.from_path(opts.db_table, id)
+        entities.append(entity)
+    return entities
+
+
+def run(sizes=(1000, 10000), using=DEFAULT_DB_ALIAS):
+    """
+    Returns a result dict for each number of rows, with seconds taken
+    by each of the ways to decode them.
+    """
+    connection = connections[using]
+    compiler = FieldsWithoutOptionsModel.objects.using(using).all() \
+        .query.get_compiler(using)
+    fields = compiler.get_fields()
+    decoder = get_row_decoder(FieldsWithoutOptionsModel, fields,
+                              connection)
+
+    results = []
+    for size in sizes:
+        entities = make_entities(connection, size)
+
+        start = time.time()
+        for entity in entities:
+            compiler._make_result(entity, fields)
+        make_result_time = time.time() - start
+
+        start = time.time()
+        for offset in xrange(0, size, DECODE_BATCH_SIZE):
+            decoder.decode(entities[offset:offset + DECODE_BATCH_SIZE])
+        decoder_time = time.time() - start
+
+        results.append({'benchmark': 'row_decoding', 'rows': size,
+                        'make_result': make_result_time,
+                        'row_decoder': decoder_time})
+    return results
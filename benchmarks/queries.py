@@ -0,0 +1,130 @@
+"""
+Measures time spent and datastore RPCs made by the main query shapes
+at several numbers of stored entities, using the testbed datastore
+stub (so nothing leaves the process and runs are reproducible).
+"""
+import time
+
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from ..db import instrumentation
+from ..db.stubs import stub_manager
+from ..fields import AncestorKey
+from ..tests.ancestor import AncestorModel, ChildModel
+from ..tests.testmodels import EmailModel
+from ..utils import bulk_create
+
+# Number of distinct EmailModel.number values (stored round-robin).
+NUMBERS = 10
+
+# Number of primary keys used by the pk__in shape.
+PK_IN_SIZE = 100
+
+
+def _shapes(using):
+    """
+    Returns (name, function, repeatable) tuples; functions take a list
+    of stored primary keys and the ancestor of stored children.
+    """
+    emails = EmailModel.objects.using(using)
+
+    def pk_get(pks, parent):
+        emails.get(pk=pks[len(pks) // 2])
+
+    def pk_in(pks, parent):
+        list(emails.filter(pk__in=pks[:PK_IN_SIZE]))
+
+    def in_fanout(pks, parent):
+        list(emails.filter(number__in=range(NUMBERS)))
+
+    def range_order(pks, parent):
+        list(emails.filter(number__gte=2, number__lt=8).order_by('number'))
+
+    def count(pks, parent):
+        emails.filter(number__gte=NUMBERS // 2).count()
+
+    def exclude(pks, parent):
+        list(emails.exclude(number=3))
+
+    def update(pks, parent):
+        emails.filter(number=1).update(email='rasengan@naruto.com')
+
+    def ancestor(pks, parent):
+        list(ChildModel.descendents_of(parent).using(using))
+
+    def delete(pks, parent):
+        emails.all().delete()
+
+    return [('pk_get', pk_get, True), ('pk_in', pk_in, True),
+            ('in_fanout', in_fanout, True),
+            ('range_order', range_order, True), ('count', count, True),
+            ('exclude', exclude, True), ('update', update, True),
+            ('ancestor', ancestor, True), ('delete', delete, False)]
+
+
+def _measure(func, *args):
+    """
+    Runs func, returning the time it took, the time spent waiting for
+    RPCs and the RequestStats summary.
+    """
+    instrumentation.activate()
+    try:
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+    finally:
+        stats = instrumentation.deactivate()
+    summary = stats.summary()
+    rpc_time = sum(totals['time'] for totals in summary['calls'].values())
+    return elapsed, rpc_time, summary
+
+
+def _result(shape, size, measurements):
+    elapsed, rpc_time, summary = min(measurements,
+                                     key=lambda measurement: measurement[0])
+    return {
+        'benchmark': 'queries', 'shape': shape, 'rows': size,
+        'time': elapsed, 'rpc_time': rpc_time,
+        'overhead': max(0.0, elapsed - rpc_time),
+        'rpcs': summary['rpcs'],
+        'calls': dict((call, totals['count'])
+                      for call, totals in summary['calls'].items()),
+        'entities': dict((call, totals['entities'])
+                         for call, totals in summary['calls'].items()),
+    }
+
+
+def run(sizes=(100, 1000), using=DEFAULT_DB_ALIAS, repeat=3):
+    """
+    Returns a result dict for each query shape and number of stored
+    entities, with the best of repeat runs: seconds taken, seconds
+    spent in RPCs, the rest (backend overhead) and numbers of RPCs
+    and entities by RPC method.
+
+    Each size is run against a fresh datastore stub.
+    """
+    connection = connections[using]
+    results = []
+    for size in sizes:
+        stub_manager.deactivate_test_stubs()
+        stub_manager.activate_test_stubs(connection)
+        try:
+            emails = [EmailModel(email='app-engine@scholardocs.com',
+                                 number=index % NUMBERS)
+                      for index in xrange(size)]
+            results.append(_result('bulk_create', size, [_measure(
+                EmailModel.objects.using(using).bulk_create, emails)]))
+            pks = [instance.pk for instance in emails]
+
+            parent = AncestorModel.objects.using(using).create()
+            bulk_create([ChildModel(id=AncestorKey(parent))
+                         for _ in xrange(size)], connection)
+
+            for shape, func, repeatable in _shapes(using):
+                measurements = [_measure(func, pks, parent)
+                                for _ in xrange(repeat if repeatable
+                                                else 1)]
+                results.append(_result(shape, size, measurements))
+        finally:
+            stub_manager.deactivate_test_stubs()
+    return results
@@ -82,6 +82,10 @@ class DatabaseFeatures(NonrelDatabaseFeatures):
     # used as key values.
     allows_primary_key_0 = False
 
+    # select_related() is emulated by getting related entities of each
+    # batch of results together (see SQLCompiler._add_related_rows).
+    supports_select_related = True
+
     # Anything that results in a something different than a positive
     # integer or a string cannot be directly used as a key on GAE.
     # Note that DecimalField values are encoded as strings, so can be
@@ -105,6 +109,9 @@ class DatabaseOperations(NonrelDatabaseOperations):
     # Time used to store dates as datetimes.
     DEFAULT_TIME = datetime.time()
 
+    # Start of datetimes stored as integers (in datastore indexes).
+    EPOCH = datetime.datetime(1970, 1, 1)
+
     def sql_flush(self, style, tables, sequences):
         self.connection.flush()
         return []
@@ -205,6 +212,12 @@ class DatabaseOperations(NonrelDatabaseOperations):
         if value is None:
             return None
 
+        # Projection queries return date / time values as they are
+        # indexed (microseconds since the epoch).
+        if db_type in ('date', 'datetime', 'time') and \
+                isinstance(value, (int, long)):
+            value = self.EPOCH + datetime.timedelta(microseconds=value)
+
         # All keys were converted to the Key class.
         if db_type == 'key':
             assert isinstance(value, Key), \
@@ -0,0 +1,191 @@
+from collections import deque
+
+from google.appengine.api.datastore import AllocateIds, _GetConnection
+from google.appengine.api.datastore_types import Key
+from google.appengine.datastore.datastore_query import QueryOptions
+
+
+# Number of keys passed to a single Get RPC and the number of RPCs that
+# may be running at the same time (unless set through the
+# GET_CHUNK_SIZE and MAX_CONCURRENT_RPCS database options).
+DEFAULT_GET_CHUNK_SIZE = 100
+DEFAULT_MAX_CONCURRENT_RPCS = 10
+
+# Number of keys passed to a single Delete RPC (DELETE_CHUNK_SIZE).
+DEFAULT_DELETE_CHUNK_SIZE = 500
+
+# Number of buffered entities passed to a single Put RPC
+# (PUT_CHUNK_SIZE).
+DEFAULT_PUT_CHUNK_SIZE = 500
+
+# Number of keys fetched by each RPC while counting.
+COUNT_BATCH_SIZE = 1000
+
+
+def chunked(iterable, size):
+    """
+    Splits an iterable into lists of (at most) the given size.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def allocate_keys(kind, size, parent=None):
+    """
+    Reserves ids for size new entities of the kind (with the given
+    parent key), returning their keys.
+    """
+    start, end = AllocateIds(Key.from_path(kind, 1, parent=parent),
+                             size=size)
+    return [Key.from_path(kind, id, parent=parent)
+            for id in xrange(start, end + 1)]
+
+
+def run_concurrently(make_rpc, chunks, max_in_flight):
+    """
+    Starts an asynchronous RPC (e.g. using GetAsync) for each chunk,
+    keeping no more than max_in_flight RPCs running at a time, and
+    yields (chunk, result) pairs in order.
+
+    RPCs are only started when results are being consumed, so if the
+    caller stops early no more RPCs are made.
+    """
+    rpcs = deque()
+    for chunk in chunks:
+        if len(rpcs) >= max_in_flight:
+            done, rpc = rpcs.popleft()
+            yield done, rpc.get_result()
+        rpcs.append((chunk, make_rpc(chunk)))
+    while rpcs:
+        chunk, rpc = rpcs.popleft()
+        yield chunk, rpc.get_result()
+
+
+def run_tasklets(tasklets, max_in_flight):
+    """
+    Runs generators that yield asynchronous RPCs (and get the RPC's
+    result sent back), interleaving them so that no more than
+    max_in_flight RPCs are running at a time. A tasklet may also yield
+    None, which is sent back immediately.
+
+    Tasklets are only started when there's room for their RPCs, so a
+    lazy iterable of tasklets is only consumed as needed.
+    """
+    pending = deque()
+
+    def advance(tasklet, value):
+        try:
+            rpc = tasklet.send(value)
+            while rpc is None:
+                rpc = tasklet.send(None)
+        except StopIteration:
+            return
+        pending.append((tasklet, rpc))
+
+    for tasklet in tasklets:
+        while len(pending) >= max_in_flight:
+            done, rpc = pending.popleft()
+            advance(done, rpc.get_result())
+        advance(tasklet, None)
+    while pending:
+        tasklet, rpc = pending.popleft()
+        advance(tasklet, rpc.get_result())
+
+
+class BatchedQueryRun(object):
+    """
+    Iterates over the results of a datastore Query batch by batch.
+
+    With background_fetch the RPC for the following batch is started
+    before the results of the current one are handed out, so the next
+    batch is transferred while the caller processes the current one;
+    otherwise it's only requested once the current batch is used up.
+
+    The cursor attribute points after the last batch that was fully
+    iterated over.
+    """
+
+    def __init__(self, query, background_fetch=True, **options):
+        self.background_fetch = background_fetch
+        options = query.GetQueryOptions().merge(QueryOptions(**options))
+        self.cursor = None
+        self._rpc = query.GetQuery().run_async(_GetConnection(), options)
+
+    def __iter__(self):
+        for results, _ in self.batches():
+            for result in results:
+                yield result
+
+    def batches(self):
+        """
+        Yields a list of results for each batch along with a cursor
+        pointing after the batch.
+        """
+        rpc, self._rpc = self._rpc, None
+        while rpc is not None:
+            batch = rpc.get_result()
+            rpc = None
+            if self.background_fetch and batch.more_results:
+                rpc = batch.next_batch_async()
+
+            yield batch.results, batch.end_cursor
+            self.cursor = batch.end_cursor
+
+            if not self.background_fetch and batch.more_results:
+                rpc = batch.next_batch_async()
+
+
+def count_keys(runs, limit=None, excluded=(), distinct=False,
+               max_in_flight=None):
+    """
+    Counts keys returned by keys-only BatchedQueryRuns, taking a batch
+    from each of them in turn (so all of them keep fetching in the
+    background), stopping as soon as limit is reached.
+
+    Runs are taken from the (possibly lazy) iterable as needed, so that
+    no more than max_in_flight of them are active at a time (if given).
+
+    Excluded keys are not counted, neither are keys already returned by
+    another run if distinct is set.
+    """
+    excluded = set(excluded)
+    seen = set()
+    count = 0
+    runs = iter(runs)
+    pending = deque()
+
+    def start():
+        for run in runs:
+            pending.append(run.batches())
+            return True
+        return False
+
+    while (max_in_flight is None or len(pending) < max_in_flight) and \
+            start():
+        pass
+    while pending:
+        batches = pending.popleft()
+        for keys, _ in batches:
+            pending.append(batches)
+            break
+        else:
+            start()
+            continue
+
+        for key in keys:
+            if key in excluded:
+                continue
+            if distinct:
+                if key in seen:
+                    continue
+                seen.add(key)
+            count += 1
+            if count == limit:
+                return count
+    return count
@@ -0,0 +1,116 @@
+from contextlib import contextmanager
+import threading
+
+from google.appengine.api import memcache
+from google.appengine.api.datastore import Entity, IsInTransaction
+
+from .db_settings import get_model_entity_cache
+
+
+# Prefix of memcache keys holding serialized entities.
+KEY_PREFIX = 'djangoappengine:entity:'
+
+# Value stored in place of an entity that is being written (or read
+# from the datastore), so concurrent readers don't cache an old copy,
+# and the number of seconds after which it expires.
+LOCKED = 0
+LOCK_TIME = 32
+
+_local = threading.local()
+
+
+def entity_cache_enabled(model, connection):
+    """
+    Checks if entities of the model should be cached, either because
+    the model is listed as True in an ENTITY_CACHE dict of one of the
+    GAE_SETTINGS_MODULES, or because the ENTITY_CACHE database option
+    is set and the model wasn't opted out.
+    """
+    enabled = get_model_entity_cache(model)
+    if enabled is None:
+        enabled = connection.settings_dict.get('ENTITY_CACHE', False)
+    return enabled
+
+
+def cache_key(key):
+    return KEY_PREFIX + str(key)
+
+
+class CachedRead(object):
+    """
+    Looks entities up in memcache, locking keys of entities that are
+    not cached, so that after they have been fetched from the datastore
+    they can be stored unless they were written in the meantime (using
+    compare-and-set, the same way NDB does).
+
+    Cached entities are available in the entities dict.
+    """
+
+    def __init__(self, keys):
+        self.client = memcache.Client()
+        keys = dict((cache_key(key), key) for key in keys)
+        values = self.client.get_multi(keys.keys())
+
+        self.entities = {}
+        for name, value in values.iteritems():
+            if value != LOCKED:
+                self.entities[keys[name]] = Entity.FromPb(value)
+
+        self.locked = set()
+        missing = [name for name in keys if name not in values]
+        if missing:
+            not_added = self.client.add_multi(
+                dict((name, LOCKED) for name in missing), time=LOCK_TIME)
+            added = [name for name in missing if name not in not_added]
+            if added:
+                self.client.get_multi(added, for_cas=True)
+                self.locked = set(keys[name] for name in added)
+
+    def store(self, entities):
+        """
+        Caches entities fetched from the datastore (skipping missing
+        ones), unless they were locked by a writer.
+        """
+        values = dict((cache_key(entity.key()), entity.ToPb().Encode())
+                      for entity in entities
+                      if entity is not None and entity.key() in self.locked)
+        if values:
+            self.client.cas_multi(values)
+
+
+def lock(keys):
+    """
+    Marks entities as being written, so they are neither read from nor
+    stored in the cache until invalidated (or until LOCK_TIME passes).
+    """
+    memcache.set_multi(dict((cache_key(key), LOCKED) for key in keys),
+                       time=LOCK_TIME)
+
+
+def invalidate(keys):
+    """
+    Removes cached copies of written entities. Inside a commit_locked
+    transaction this is postponed until the transaction is committed.
+    """
+    if IsInTransaction():
+        pending = getattr(_local, 'pending', None)
+        if pending is not None:
+            pending.extend(keys)
+        return
+    memcache.delete_multi([cache_key(key) for key in keys])
+
+
+@contextmanager
+def invalidate_after_commit():
+    """
+    Collects keys of entities written in a transaction, invalidating
+    them after it's committed.
+    """
+    previous = getattr(_local, 'pending', None)
+    _local.pending = pending = []
+    try:
+        yield
+    finally:
+        _local.pending = previous
+    if pending:
+        memcache.delete_multi([cache_key(key) for key in set(pending)])
@@ -2,17 +2,19 @@ from functools import wraps
 import sys
 import logging
 
+from django.db.models.expressions import ExpressionNode, F
 from django.db.models.fields import AutoField
 from django.db.models.sql import aggregates as sqlaggregates
 from django.db.models.sql.constants import LOOKUP_SEP, MULTI, SINGLE
-from django.db.models.sql.where import AND, OR
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.db.utils import DatabaseError, IntegrityError
-from django.utils.tree import Node
 from django.db.models.sql.compiler import MULTI, empty_iter
 
 from google.appengine.api.datastore import Entity, Query, MultiQuery, \
-    Put, Get, Delete
-from google.appengine.api.datastore_errors import Error as GAEError
+    GetAsync, PutAsync, DeleteAsync, IsInTransaction, _GetConnection
+from google.appengine.api.datastore_errors import Error as GAEError, \
+    TransactionFailedError
+from google.appengine.datastore.datastore_rpc import TransactionOptions
 from google.appengine.api.datastore_types import Key, Text
 from google.appengine.ext import db
 
@@ -24,10 +26,20 @@ from djangotoolbox.db.basecompiler import (
     NonrelDeleteCompiler)
 
 from .base import InvalidGaeKey
+from . import cache, context, counters, writes
+from .instrumentation import instrumented
+from .batch import BatchedQueryRun, chunked, count_keys, \
+    run_concurrently, run_tasklets, COUNT_BATCH_SIZE, \
+    DEFAULT_DELETE_CHUNK_SIZE, DEFAULT_GET_CHUNK_SIZE, \
+    DEFAULT_MAX_CONCURRENT_RPCS, DEFAULT_PUT_CHUNK_SIZE
 from .db_settings import get_model_indexes
+from .decoders import get_row_decoder, DECODE_BATCH_SIZE
 from .expressions import ExpressionEvaluator
-from .utils import commit_locked
-from ..fields import AncestorKey
+from .multiquery import ConcurrentMultiQuery, MAX_ROUND_SIZE
+from .ordering import sort_entities
+from .plans import QueryPlan, cache_plan, get_insert_plan, get_plan
+from .predicates import bind_where, get_predicate
+from ..fields import AncestorKey, ShardedCounterField
 
 
 # Valid query types (a dictionary is used for speedy lookups).
@@ -60,6 +72,18 @@ NEGATION_MAP = {
 # it from the lack of value.
 NOT_PROVIDED = object()
 
+# Number of times update transactions are retried on concurrent writes
+# (unless set through the update_retries option).
+DEFAULT_UPDATE_RETRIES = 3
+
+# Number of __scatter__ samples taken for each count shard.
+SCATTER_OVERSAMPLING = 32
+
+# Storage types of single-valued properties that can be fetched with a
+# projection query (when indexed).
+PROJECTION_DB_TYPES = ('key', 'string', 'integer', 'long', 'bool', 'float',
+                       'decimal', 'date', 'datetime', 'time')
+
 
 def safe_call(func):
     """
@@ -92,35 +116,70 @@ class GAEQuery(NonrelQuery):
         self.ancestor_key = None
         self.excluded_pks = ()
         self.has_negated_exact_filter = False
+        self.has_relation_in_filter = False
+        self.emulated_filter = False
+        self.in_memory_sort = False
         self.ordering = []
+        self._predicate = None
+        self._projection = None
+        self._leaves = None
+        self._templates = None
+        self._leaf = None
+        self._touched = False
         self.db_table = self.query.get_meta().db_table
         self.pks_only = (len(fields) == 1 and fields[0].primary_key)
-        start_cursor = getattr(self.query, '_gae_start_cursor', None)
-        end_cursor = getattr(self.query, '_gae_end_cursor', None)
+        self._start_cursor = getattr(self.query, '_gae_start_cursor', None)
+        self._end_cursor = getattr(self.query, '_gae_end_cursor', None)
         self.gae_query = [Query(self.db_table, keys_only=self.pks_only,
-                                cursor=start_cursor, end_cursor=end_cursor)]
+                                cursor=self._start_cursor,
+                                end_cursor=self._end_cursor)]
 
     # This is needed for debugging.
     def __repr__(self):
         return '<GAEQuery: %r ORDER %r>' % (self.gae_query, self.ordering)
 
+    @instrumented('fetch')
     @safe_call
     def fetch(self, low_mark=0, high_mark=None):
         query = self._build_query()
+
+        # Keep whole entities returned by queries in the request's
+        # context cache (pk lookups add fetched entities themselves).
+        fill_context = self.included_pks is None and not self.pks_only and \
+            not self._projection and \
+            context.get_context_cache() is not None and \
+            not IsInTransaction()
+
+        for entity in self._fetch_entities(query, low_mark, high_mark):
+            if fill_context:
+                context.add_entities((entity,))
+            yield self._make_entity(entity)
+
+    @safe_call
+    def fetch_entities(self, low_mark=0, high_mark=None):
+        """
+        Returns an iterator over datastore entities (or keys, for
+        keys-only queries) matching the query, as they come from the
+        datastore.
+        """
+        return self._fetch_entities(self._build_query(), low_mark,
+                                    high_mark)
+
+    def _fetch_entities(self, query, low_mark, high_mark):
         executed = False
         if self.excluded_pks and high_mark is not None:
             high_mark += len(self.excluded_pks)
         if self.included_pks is not None:
             results = self.get_matching_pk(low_mark, high_mark)
+        elif self._use_keys_only_fanout(query):
+            results = self._get_fanout_entities(low_mark, high_mark)
         else:
             if high_mark is None:
-                kw = {}
-                if low_mark:
-                    kw['offset'] = low_mark
-                results = query.Run(**kw)
+                results = self._run_query(query, low_mark)
                 executed = True
             elif high_mark > low_mark:
-                results = query.Get(high_mark - low_mark, low_mark)
+                results = self._run_query(query, low_mark,
+                                          high_mark - low_mark)
                 executed = True
             else:
                 results = ()
@@ -133,41 +192,127 @@ class GAEQuery(NonrelQuery):
             if key in self.excluded_pks:
                 continue
 
-            yield self._make_entity(entity)
+            yield entity
 
-        if executed and not isinstance(query, MultiQuery):
+        if executed and not isinstance(query, (MultiQuery,
+                                               ConcurrentMultiQuery)):
             try:
-                self.query._gae_cursor = query.GetCompiledCursor()
+                if isinstance(results, BatchedQueryRun):
+                    self.query._gae_cursor = results.cursor
+                else:
+                    self.query._gae_cursor = query.GetCompiledCursor()
             except:
                 pass
 
+    @instrumented('count')
     @safe_call
     def count(self, limit=NOT_PROVIDED):
+        """
+        Counts matching entities using keys-only queries, stopping at
+        limit if one is given.
+        """
         if self.included_pks is not None:
-            return len(self.get_matching_pk(0, limit))
-        if self.excluded_pks:
-            return len(list(self.fetch(0, 2000)))
-        # The datastore's Count() method has a 'limit' kwarg, which has
-        # a default value (obviously).  This value can be overridden to
-        # anything you like, and importantly can be overridden to
-        # unlimited by passing a value of None.  Hence *this* method
-        # has a default value of NOT_PROVIDED, rather than a default
-        # value of None
-        kw = {}
-        if limit is not NOT_PROVIDED:
-            kw['limit'] = limit
-        return self._build_query().Count(**kw)
-
+            if limit is NOT_PROVIDED:
+                limit = None
+            return len(list(self.get_matching_pk(0, limit)))
+
+        queries = self._build_keys_only_queries()
+        if len(queries) == 1 and not self.excluded_pks:
+            shards = self._shard_count_query(queries[0], limit)
+            if shards is None:
+                # The datastore's Count() method has a 'limit' kwarg,
+                # which has a default value (obviously).  This value
+                # can be overridden to anything you like, and
+                # importantly can be overridden to unlimited by passing
+                # a value of None.  Hence *this* method has a default
+                # value of NOT_PROVIDED, rather than a default value of
+                # None
+                kw = {}
+                if limit is not NOT_PROVIDED:
+                    kw['limit'] = limit
+                return queries[0].Count(**kw)
+            queries = shards
+
+        # Page through keys (following batch cursors), removing any
+        # excluded ones.
+        if limit is NOT_PROVIDED:
+            limit = None
+        kw = {'batch_size': COUNT_BATCH_SIZE}
+        if limit is not None:
+            kw['limit'] = limit + len(self.excluded_pks)
+        runs = (BatchedQueryRun(query, True, **kw) for query in queries)
+        return count_keys(runs, limit, self.excluded_pks,
+                          distinct=len(self.gae_query) > 1,
+                          max_in_flight=self._max_concurrent_rpcs())
+
+    @instrumented('delete')
     @safe_call
     def delete(self):
+        """
+        Deletes matching entities without loading them: keys from
+        keys-only queries are streamed to concurrent Delete RPCs in
+        chunks of DELETE_CHUNK_SIZE keys.
+
+        When a single query is run, the cursor after the last deleted
+        chunk is kept as the query's _gae_cursor (None once everything
+        has been deleted), so a delete stopped after a delete_limit
+        number of keys (see db.utils.delete_entities) can be resumed.
+        """
+        chunk_size = self.connection.settings_dict.get(
+            'DELETE_CHUNK_SIZE', DEFAULT_DELETE_CHUNK_SIZE)
+        limit = getattr(self.query, '_gae_config', {}).get('delete_limit')
+        excluded = set(self.excluded_pks)
+
+        # Buffered entities may match the query.
+        writes.flush()
+
+        queries = ()
         if self.included_pks is not None:
             keys = [key for key in self.included_pks if key is not None]
+            chunks = ((chunk, None) for chunk in chunked(keys[:limit],
+                                                         chunk_size))
         else:
-            keys = self.fetch()
-
-        keys = list(keys)
-        if keys:
-            Delete(keys)
+            queries = self._build_keys_only_queries()
+            kw = {'batch_size': chunk_size}
+            if limit is not None:
+                kw['limit'] = limit
+            if len(queries) == 1:
+                chunks = BatchedQueryRun(queries[0], True, **kw).batches()
+            else:
+                keys = ConcurrentMultiQuery(
+                    queries, self.ordering,
+                    self._max_concurrent_rpcs()).Run(**kw)
+                chunks = ((chunk, None) for chunk in chunked(keys,
+                                                             chunk_size))
+
+        cached = cache.entity_cache_enabled(self.query.model,
+                                            self.connection)
+        scanned = [0]
+
+        def deletable(chunks):
+            for keys, cursor in chunks:
+                scanned[0] += len(keys)
+                keys = [key for key in keys if key not in excluded]
+                if keys:
+                    yield keys, cursor
+
+        def delete_chunk(chunk):
+            keys, _ = chunk
+            if cached:
+                cache.lock(keys)
+            return DeleteAsync(keys)
+
+        for (keys, cursor), _ in run_concurrently(
+                delete_chunk, deletable(chunks),
+                self._max_concurrent_rpcs()):
+            if cached:
+                cache.invalidate(keys)
+            context.evict(keys)
+            if cursor is not None:
+                self.query._gae_cursor = cursor
+
+        if len(queries) == 1 and (limit is None or scanned[0] < limit):
+            self.query._gae_cursor = None
 
     @safe_call
     def order_by(self, ordering):
@@ -193,12 +338,52 @@ class GAEQuery(NonrelQuery):
             else:
                 raise DatabaseError("Invalid value for a key lookup on GAE.")
 
+    def add_filters(self, filters):
+        """
+        Adds filters for the given WHERE tree, reusing a cached plan
+        built for trees of the same shape (see db.plans) if there is
+        one, so only the lookup values have to be bound. Plans can be
+        disabled using the QUERY_PLAN_CACHE database option.
+        """
+        if self._leaves is not None or not \
+                self.connection.settings_dict.get('QUERY_PLAN_CACHE', True):
+            return super(GAEQuery, self).add_filters(filters)
+
+        # Decode leaves of the tree, collecting them in add_filter.
+        self._leaves = []
+        try:
+            super(GAEQuery, self).add_filters(filters)
+        finally:
+            leaves, self._leaves = self._leaves, None
+
+        key = self._get_plan_key(leaves)
+        plan = get_plan(key)
+        if plan is None:
+            cache_plan(key, self._build_plan(leaves))
+            return
+
+        self.gae_query = plan.bind(self.db_table,
+                                   [value for _, _, _, value in leaves],
+                                   self.pks_only, self._start_cursor,
+                                   self._end_cursor)
+        self.inequality_field = plan.inequality_field
+        self.has_negated_exact_filter = plan.has_negated_exact_filter
+        self.has_relation_in_filter = any(
+            lookup_type == 'in' and field.rel and not negated
+            for field, lookup_type, negated, _ in leaves)
+        for index in plan.special:
+            self.add_filter(*leaves[index])
+
     @safe_call
     def add_filter(self, field, lookup_type, negated, value):
         """
         This function is used by the default add_filters()
         implementation.
         """
+        if self._leaves is not None:
+            self._leaves.append((field, lookup_type, negated, value))
+            return
+
         if lookup_type == 'ancestor':
             self.ancestor_key = Key.from_path(value._meta.db_table, value.pk)
             return
@@ -242,13 +427,15 @@ class GAEQuery(NonrelQuery):
                 op = '>'
             else:
                 op = '='
-            value = None
+            self._add_filter(field, op, None, NOT_PROVIDED)
+            return
         elif negated and lookup_type == 'exact':
             if self.has_negated_exact_filter:
                 raise DatabaseError("You can't exclude more than one __exact "
                                     "filter.")
             self.has_negated_exact_filter = True
-            self._combine_filters(field, (('<', value), ('>', value)))
+            self._combine_filters(field, (('<', value, None),
+                                          ('>', value, None)))
             return
         elif negated:
             try:
@@ -262,22 +449,28 @@ class GAEQuery(NonrelQuery):
                                     (field, self.inequality_field))
             self.inequality_field = field
         elif lookup_type == 'in':
+            if field.rel:
+                self.has_relation_in_filter = True
             # Create sub-query combinations, one for each value.
-            if len(self.gae_query) * len(value) > 30:
+            max_combinations = self.connection.settings_dict.get(
+                'MAX_IN_COMBINATIONS')
+            if max_combinations is not None and \
+                    len(self.gae_query) * len(value) > max_combinations:
                 raise DatabaseError("You can't query against more than "
-                                    "30 __in filter value combinations.")
-            op_values = [('=', v) for v in value]
+                                    "%d __in filter value combinations." %
+                                    max_combinations)
+            op_values = [('=', v, index) for index, v in enumerate(value)]
             self._combine_filters(field, op_values)
             return
         elif lookup_type == 'startswith':
             # Lookup argument was converted to [arg, arg + u'\ufffd'].
-            self._add_filter(field, '>=', value[0])
-            self._add_filter(field, '<=', value[1])
+            self._add_filter(field, '>=', value[0], 0)
+            self._add_filter(field, '<=', value[1], 1)
             return
         elif lookup_type in ('range', 'year'):
-            self._add_filter(field, '>=', value[0])
+            self._add_filter(field, '>=', value[0], 0)
             op = '<=' if lookup_type == 'range' else '<'
-            self._add_filter(field, op, value[1])
+            self._add_filter(field, op, value[1], 1)
             return
         else:
             op = OPERATORS_MAP[lookup_type]
@@ -288,8 +481,15 @@ class GAEQuery(NonrelQuery):
     # Internal API
     # ----------------------------------------------
 
-    def _add_filter(self, field, op, value):
-        for query in self.gae_query:
+    def _add_filter(self, field, op, value, index=None):
+        """
+        Adds a filter to all sub-queries. While a plan is being built
+        the filter is also added to the plan's templates, referring to
+        the lookup value (or its index-th element; NOT_PROVIDED stands
+        for a value not depending on the lookup's).
+        """
+        self._touched = True
+        for position, query in enumerate(self.gae_query):
 
             # GAE uses a special property name for primary key filters.
             if field.primary_key:
@@ -315,30 +515,258 @@ class GAEQuery(NonrelQuery):
             else:
                 query[key] = value
 
+            if self._templates is not None:
+                if index is NOT_PROVIDED:
+                    entry = (key, None, None, value)
+                else:
+                    entry = (key, self._leaf, index, None)
+                self._templates[position].append(entry)
+
     def _combine_filters(self, field, op_values):
         gae_query = self.gae_query
+        templates = self._templates
         combined = []
-        for query in gae_query:
-            for op, value in op_values:
+        combined_templates = []
+        for position, query in enumerate(gae_query):
+            for op, value, index in op_values:
                 self.gae_query = [Query(self.db_table,
                                         keys_only=self.pks_only)]
                 self.gae_query[0].update(query)
-                self._add_filter(field, op, value)
+                if templates is not None:
+                    self._templates = [list(templates[position])]
+                self._add_filter(field, op, value, index)
                 combined.append(self.gae_query[0])
+                if templates is not None:
+                    combined_templates.append(self._templates[0])
         self.gae_query = combined
+        if templates is not None:
+            self._templates = combined_templates
+
+    def _get_plan_key(self, leaves):
+        """
+        Returns a key identifying plans that can be used for the given
+        decoded WHERE tree leaves: besides fields, lookup types and
+        negations, it includes any properties of the lookup values that
+        change the structure of the query.
+        """
+        shape = []
+        for field, lookup_type, negated, value in leaves:
+            if lookup_type == 'ancestor':
+                shape.append((None, lookup_type, negated, None))
+                continue
+            if value in ([], ()):
+                kind = 'empty'
+            elif field.primary_key and lookup_type in ('exact', 'in'):
+                kind = 'pk'
+            elif lookup_type == 'in':
+                kind = len(value)
+            elif lookup_type == 'isnull':
+                kind = bool(value)
+            else:
+                kind = None
+            shape.append((field.column, lookup_type, negated, kind))
+        return (self.connection.alias, self.db_table, self.pks_only,
+                tuple(shape))
+
+    def _build_plan(self, leaves):
+        """
+        Adds filters for the decoded leaves, returning a QueryPlan
+        recording how the resulting sub-queries were built.
+        """
+        first_query = self.gae_query[0]
+        special = []
+        self._templates = [[]]
+        try:
+            for index, leaf in enumerate(leaves):
+                self._leaf = index
+                self._touched = False
+                self.add_filter(*leaf)
+                if not self._touched:
+                    special.append(index)
+            templates = self._templates
+        finally:
+            self._templates = None
+        cursors = len(self.gae_query) == 1 and \
+            self.gae_query[0] is first_query
+        return QueryPlan(templates, special, cursors, self.inequality_field,
+                         self.has_negated_exact_filter)
+
+    def _build_keys_only_queries(self):
+        cursors = {}
+        if len(self.gae_query) == 1:
+            cursors = {'cursor': self._start_cursor,
+                       'end_cursor': self._end_cursor}
+        queries = []
+        for query in self.gae_query:
+            keys_query = Query(self.db_table, keys_only=True, **cursors)
+            keys_query.update(query)
+            keys_query.Order(*self.ordering)
+            if self.ancestor_key:
+                keys_query.Ancestor(self.ancestor_key)
+            queries.append(keys_query)
+        return queries
+
+    def _shard_count_query(self, query, limit):
+        """
+        Splits an unlimited count over a big kind into key ranges that
+        are counted in parallel, using the COUNT_SHARDS database option
+        or the shards set with set_count_shards(). Split points are
+        sampled from the __scatter__ property.
+
+        Returns None if the query shouldn't (or can't) be sharded.
+        """
+        shards = self.connection.settings_dict.get('COUNT_SHARDS')
+        shards = getattr(self.query, '_gae_config', {}).get('count_shards',
+                                                             shards)
+        if not shards or shards < 2 or limit is not None or \
+                self.ordering or self.inequality_field is not None or \
+                self._start_cursor or self._end_cursor:
+            return None
+
+        samples = Query(self.db_table, keys_only=True).Order(
+            '__scatter__').Get(shards * SCATTER_OVERSAMPLING)
+        if not samples:
+            return None
+        samples.sort()
+        split_keys = sorted(set(samples[len(samples) * index // shards]
+                                for index in range(1, shards)))
+
+        bounds = [None] + split_keys + [None]
+        queries = []
+        for lower, upper in zip(bounds, bounds[1:]):
+            shard = Query(self.db_table, keys_only=True)
+            shard.update(query)
+            if lower is not None:
+                shard['__key__ >='] = lower
+            if upper is not None:
+                shard['__key__ <'] = upper
+            if self.ancestor_key:
+                shard.Ancestor(self.ancestor_key)
+            queries.append(shard)
+        return queries
+
+    def _get_batch_options(self):
+        """
+        Returns batching options set for the queryset (using
+        set_batch_options) or for the whole database.
+        """
+        settings_dict = self.connection.settings_dict
+        options = {
+            'batch_size': settings_dict.get('BATCH_SIZE'),
+            'prefetch_size': settings_dict.get('PREFETCH_SIZE'),
+            'background_fetch': settings_dict.get('BACKGROUND_FETCH'),
+        }
+        config = getattr(self.query, '_gae_config', {})
+        for name in options:
+            if name in config:
+                options[name] = config[name]
+        return options
+
+    def _run_query(self, query, offset=0, limit=None):
+        options = self._get_batch_options()
+        background_fetch = options.pop('background_fetch')
+        kw = dict((name, value) for name, value in options.items()
+                  if value is not None)
+
+        if limit is not None:
+            # Without explicit batching options ask for the whole slice
+            # at once (the same way Query.Get does).
+            if not kw and not isinstance(query, ConcurrentMultiQuery):
+                kw['batch_size'] = limit
+            kw['limit'] = limit
+        if offset:
+            kw['offset'] = offset
+
+        # The SDK's MultiQuery subclasses Query, but can't be run in
+        # batches.
+        if background_fetch is not None and type(query) is Query:
+            return BatchedQueryRun(query, background_fetch, **kw)
+        return query.Run(**kw)
 
     def _make_entity(self, entity):
+        """
+        Returns a dict of the entity's properties with its key as the
+        primary key column. Entities may be shared with the context
+        cache or the write buffer, so they are not changed.
+        """
         if isinstance(entity, Key):
             key = entity
             entity = {}
         else:
             key = entity.key()
+            entity = dict(entity)
 
         entity[self.query.get_meta().pk.column] = key
         return entity
 
+    def _get_projection(self):
+        """
+        Returns names of properties to fetch using a projection query,
+        or None if whole entities should be fetched.
+
+        Projections are only used when a subset of fields is selected
+        (by values(), values_list() or only()) and all of the selected
+        and ordering properties are indexed, single-valued and not
+        constrained by an equality filter. Note that projection queries
+        skip entities that have no value stored for a projected
+        property (None is a value), and that projecting more than one
+        property (or filtering or ordering on other ones) needs a
+        composite index, so they have to be enabled using the
+        PROJECTION_QUERIES database option.
+        """
+        if self.pks_only or self.included_pks is not None or \
+                not self.connection.settings_dict.get('PROJECTION_QUERIES',
+                                                      False):
+            return None
+        opts = self.query.get_meta()
+        if set(self.fields) >= set(opts.fields):
+            return None
+
+        unindexed = get_model_indexes(self.query.model)['unindexed']
+        fields_by_column = dict((field.column, field)
+                                for field in opts.fields)
+        projection = []
+        columns = [field.column for field in self.fields]
+        columns.extend(column for column, _ in self.ordering)
+        for column in columns:
+            field = fields_by_column.get(column)
+            if field is None or field.primary_key or column in projection:
+                continue
+            _, _, db_type = self.ops._convert_as(field)
+            if field.attname in unindexed or \
+                    db_type not in PROJECTION_DB_TYPES:
+                return None
+            projection.append(column)
+        if not projection:
+            return None
+
+        for query in self.gae_query:
+            for filter in query:
+                column, op = filter.rsplit(' ', 1)
+                if column in projection and op in ('=', '=='):
+                    return None
+        return projection
+
+    def _build_projection_queries(self, projection):
+        cursors = {}
+        if len(self.gae_query) == 1:
+            cursors = {'cursor': self._start_cursor,
+                       'end_cursor': self._end_cursor}
+        queries = []
+        for query in self.gae_query:
+            projection_query = Query(self.db_table, projection=projection,
+                                     **cursors)
+            projection_query.update(query)
+            queries.append(projection_query)
+        return queries
+
     @safe_call
     def _build_query(self):
+        self._projection = self._get_projection()
+        if self._projection:
+            self.gae_query = self._build_projection_queries(
+                self._projection)
+
         for query in self.gae_query:
             query.Order(*self.ordering)
 
@@ -347,134 +775,181 @@ class GAEQuery(NonrelQuery):
                 query.Ancestor(self.ancestor_key)
 
         if len(self.gae_query) > 1:
-            return MultiQuery(self.gae_query, self.ordering)
+            if self.connection.settings_dict.get('CONCURRENT_MULTIQUERY',
+                                                 True):
+                return ConcurrentMultiQuery(self.gae_query, self.ordering,
+                                            self._max_concurrent_rpcs())
+
+            # The SDK's MultiQuery can't take more than 30 sub-queries,
+            # so run bigger combinations as rounds merged together.
+            rounds = [MultiQuery(self.gae_query[start:start + MAX_ROUND_SIZE],
+                                 self.ordering)
+                      for start in range(0, len(self.gae_query),
+                                         MAX_ROUND_SIZE)]
+            if len(rounds) == 1:
+                return rounds[0]
+            return ConcurrentMultiQuery(rounds, self.ordering,
+                                        self._max_concurrent_rpcs())
         return self.gae_query[0]
 
+    def _use_keys_only_fanout(self, query):
+        """
+        Checks if entities matched by the sub-queries of an __in lookup
+        on a related field (e.g. the one done by prefetch_related for
+        a reverse ForeignKey) should be looked up by keys. Can be
+        disabled using the KEYS_ONLY_FANOUT database option.
+        """
+        return self.has_relation_in_filter and \
+            isinstance(query, (MultiQuery, ConcurrentMultiQuery)) and \
+            not self.ordering and not self.pks_only and \
+            not self._projection and \
+            self.connection.settings_dict.get('KEYS_ONLY_FANOUT', True)
+
+    def _get_fanout_entities(self, low_mark=0, high_mark=None):
+        """
+        Yields entities matching the query, running its sub-queries as
+        concurrent keys-only queries and getting entities for the
+        merged keys in chunks (so that cached entities don't have to be
+        fetched again). Entities changed since the keys were indexed
+        are checked against the filters again.
+        """
+        kw = {}
+        if high_mark is not None:
+            if high_mark <= low_mark:
+                return
+            kw['limit'] = high_mark - low_mark
+        if low_mark:
+            kw['offset'] = low_mark
+        keys = ConcurrentMultiQuery(self._build_keys_only_queries(), [],
+                                    self._max_concurrent_rpcs()).Run(**kw)
+        for chunk in self._get_chunks(list(keys)):
+            for entity in self.results_match_filters(chunk,
+                                                     self.query.where):
+                yield entity
+
     def get_matching_pk(self, low_mark=0, high_mark=None):
-        if not self.included_pks:
-            return []
+        """
+        Yields entities with the included keys that match the query's
+        filters, fetching keys in chunks with concurrent Get RPCs.
 
-        results = self.results_match_filters(Get(self.included_pks), self.query.where)
+        Without ordering only the first high_mark keys are fetched (and
+        some more if any of them are filtered out).
+        """
+        if not self.included_pks or \
+                (high_mark is not None and high_mark <= low_mark):
+            return
 
         if self.ordering:
-            results.sort(cmp=self.order_pk_filtered)
+            self.in_memory_sort = True
+            results = []
+            for chunk in self._get_chunks(self.included_pks):
+                results.extend(self.results_match_filters(chunk,
+                                                          self.query.where))
+            for entity in sort_entities(results, self.ordering,
+                                        low_mark, high_mark):
+                yield entity
+            return
 
-        results = results[low_mark:high_mark]
-        return results
+        matched = 0
+        position = 0
+        keys = self.included_pks
+        while position < len(keys):
+            if high_mark is None:
+                window = keys[position:]
+            else:
+                window = keys[position:position + high_mark - matched]
+            position += len(window)
+
+            for chunk in self._get_chunks(window):
+                for entity in self.results_match_filters(chunk,
+                                                         self.query.where):
+                    matched += 1
+                    if matched > low_mark:
+                        yield entity
+                    if matched == high_mark:
+                        return
+
+    def _get_chunks(self, keys):
+        """
+        Yields lists of entities (or Nones) for consecutive chunks of
+        keys, taking any buffered ones (see db.writes) or cached ones
+        from the request's context cache or the entity cache (outside
+        of transactions).
+        """
+        chunk_size = self.connection.settings_dict.get(
+            'GET_CHUNK_SIZE', DEFAULT_GET_CHUNK_SIZE)
+        context_cache = context.get_context_cache()
+        memcached = cache.entity_cache_enabled(self.query.model,
+                                               self.connection)
+        in_transaction = IsInTransaction()
+        buffered = {}
+        if not in_transaction:
+            buffered = writes.get_buffered(keys)
+        if in_transaction or (context_cache is None and not memcached and
+                              not buffered):
+            for _, entities in run_concurrently(
+                    GetAsync, chunked(keys, chunk_size),
+                    self._max_concurrent_rpcs()):
+                yield entities
+            return
 
-    def order_pk_filtered(self, lhs, rhs):
-        left = dict(lhs)
-        left[self.query.get_meta().pk.column] = lhs.key().to_path()
-        right = dict(rhs)
-        right[self.query.get_meta().pk.column] = rhs.key().to_path()
-        return self._order_in_memory(left, right)
+        found = buffered
+        if context_cache is not None:
+            found.update(context_cache.get_multi(
+                [key for key in keys if key not in found]))
+        read = None
+        if memcached:
+            read = cache.CachedRead([key for key in keys
+                                     if key not in found])
+            found.update(read.entities)
+            context.add_entities(read.entities.itervalues())
+        missing = [key for key in keys if key not in found]
+
+        def fetch_missing():
+            for _, entities in run_concurrently(
+                    GetAsync, chunked(missing, chunk_size),
+                    self._max_concurrent_rpcs()):
+                if read is not None:
+                    read.store(entities)
+                context.add_entities(entities)
+                for entity in entities:
+                    yield entity
+
+        fetched = fetch_missing()
+        for chunk in chunked(keys, chunk_size):
+            yield [found[key] if key in found else fetched.next()
+                   for key in chunk]
+
+    def _max_concurrent_rpcs(self):
+        return self.connection.settings_dict.get(
+            'MAX_CONCURRENT_RPCS', DEFAULT_MAX_CONCURRENT_RPCS)
 
     def results_match_filters(self, results, query_where):
         """
-        [('AND',
-          [(<django.db.models.fields.CharField: session_key>,
-            'exact',
-            datastore_types.Key.from_path(u'django_session', u'128d5afd0780589c84b5edee0333372d', _app=u'dev~g-exams')),
-           (<django.db.models.fields.DateTimeField: expire_date>,
-            'gt',
-            datetime.datetime(2013, 11, 5, 12, 45, 21, 50799))])]
-        """
-        import datetime
-        from djangotoolbox.db.basecompiler import EMULATED_OPS
-
-        class ParseNode(object):
-            def __init__(self, where):
-                self.connector = where.connector
-                self.children = []
-                self.negated = where.negated
-
-            def matches(self, item):
-                result = self.connector == AND
-
-                for child in self.children:
-                    if isinstance(child, ParseNode):
-                        submatch = child.matches(item)
-                    else:
-                        field, lookup_type, lookup_value = child
-
-                        entity_value = item[field.column]
-
-                        if entity_value is None:
-                            if isinstance(lookup_value, (datetime.datetime, datetime.date,
-                                                  datetime.time)):
-                                submatch = lookup_type in ('lt', 'lte')
-                            elif lookup_type in (
-                                    'startswith', 'contains', 'endswith', 'iexact',
-                                    'istartswith', 'icontains', 'iendswith'):
-                                submatch = False
-                            else:
-                                submatch = EMULATED_OPS[lookup_type](
-                                    entity_value, lookup_value)
-                        elif field.primary_key and field.rel and lookup_type == 'exact':
-                            #When we have a foreignkey that's a primary key, things get weird
-                            #the query might be filtering on Key('related_model', id) but we're actually
-                            #looking up on Key('this_model', id). So here we do a kindless comparison
-                            expected = Key.from_path(field.model._meta.db_table, lookup_value.id_or_name())
-                            submatch = expected == entity_value
-                        else:
-                            submatch = EMULATED_OPS[lookup_type](
-                                entity_value, lookup_value)
-
-                    if self.connector == OR and submatch:
-                        result = True
-                        break
-                    elif self.connector == AND and not submatch:
-                        result = False
-                        break
-
-                if self.negated:
-                    return not result
-
-                return result
-
-        def _parse_tree(_where):
-            if isinstance(_where, tuple):
-                return self._decode_child(_where)
-
-            node = ParseNode(_where)
-
-            for child in _where.children:
-                if isinstance(child, Node) and child.children:
-                    if len(child.children) == 1:
-                        next_level = _parse_tree(child.children[0])
-                    else:
-                        next_level = _parse_tree(child)
-                else:
-                    next_level = self._decode_child(child)
-
-                node.children.append(next_level)
-
-            return node
-
-        tree = _parse_tree(query_where)
-
-        output = []
-        for entity in results:
-            if entity is None:
-                continue
-
-            item = dict(entity)
-            item[self.query.get_meta().pk.column] = entity.key()
-
-            if tree.matches(item):
-                output.append(entity)
-
-        return output
-
+        Returns entities (fetched by key) that satisfy the constraints
+        in the given WHERE tree, skipping missing ones.
+        """
+        self.emulated_filter = True
+        predicate, values = self._get_predicate(query_where)
+        return [entity for entity in results
+                if entity is not None and predicate(entity, values)]
 
     def matches_filters(self, entity):
         """
         Checks if the GAE entity fetched from the database satisfies
         the current query's constraints.
         """
-        item = dict(entity)
-        item[self.query.get_meta().pk.column] = entity.key()
-        return self._matches_filters(item, self.query.where)
+        self.emulated_filter = True
+        predicate, values = self._get_predicate(self.query.where)
+        return predicate(entity, values)
+
+    def _get_predicate(self, where):
+        # Lookup values only need to be decoded once per query, while
+        # the predicate is shared by all queries with the same shape.
+        if self._predicate is None or self._predicate[0] is not where:
+            shape, values = bind_where(self, where)
+            self._predicate = (where, get_predicate(shape), values)
+        return self._predicate[1:]
 
 
 class SQLCompiler(NonrelCompiler):
@@ -500,37 +975,253 @@ class SQLCompiler(NonrelCompiler):
 
     def results_iter(self):
         try:
-            for x in super(SQLCompiler, self).results_iter():
+            for x in self._results_iter():
                 yield x
         except InvalidGaeKey:
             yield iter([]).next()
 
+    def _results_iter(self):
+        """
+        Same as NonrelCompiler.results_iter, but decoding batches of
+        entities using the row decoder for the selected fields (see
+        db.decoders) rather than calling _make_result for each one.
+        """
+        fields = self.get_fields()
+        try:
+            results = self.build_query(fields).fetch(
+                self.query.low_mark, self.query.high_mark)
+        except EmptyResultSet:
+            results = []
+
+        decoder = get_row_decoder(self.query.model, fields, self.connection)
+        klass_info = self._get_klass_info()
+        for entities in chunked(results, DECODE_BATCH_SIZE):
+            rows = decoder.decode(entities)
+            if klass_info is not None:
+                rows = self._add_related_rows(entities, rows, klass_info)
+            for row in rows:
+                yield row
+
+    def _get_klass_info(self):
+        """
+        Returns the description of objects to be selected along with
+        the query's model (see django.db.models.query.get_klass_info)
+        if select_related() was used, or None.
+        """
+        if not self.query.select_related:
+            return None
+        from django.db.models.query import get_klass_info
+
+        requested = self.query.select_related
+        if not isinstance(requested, dict):
+            requested = None
+        return get_klass_info(
+            self.query.model, max_depth=self.query.max_depth,
+            requested=requested,
+            only_load=self.query.get_loaded_field_names())
+
+    def _add_related_rows(self, entities, rows, klass_info):
+        """
+        Emulates select_related() joins, appending values of related
+        objects to rows (in the order in which get_cached_row reads
+        them), with related entities of a batch of rows fetched using
+        batched Gets.
+        """
+        related_fields, reverse_related_fields = klass_info[3:]
+        if reverse_related_fields:
+            raise DatabaseError("This database backend can't follow "
+                                "reverse relations in select_related().")
+        for field, related_info in related_fields:
+            if related_info is None:
+                continue
+            related = self._get_related_entities(entities, field)
+            present = [entity for entity in related if entity is not None]
+            fields = self._get_klass_fields(related_info)
+            decoder = get_row_decoder(field.rel.to, fields, self.connection)
+            related_rows = iter(self._add_related_rows(
+                present, decoder.decode(present), related_info))
+            missing = (None,) * self._get_klass_width(related_info)
+            rows = [row + (related_rows.next() if entity is not None
+                           else missing)
+                    for row, entity in zip(rows, related)]
+        return rows
+
+    def _get_related_entities(self, entities, field):
+        """
+        Returns entities referenced by the field of the given ones (or
+        Nones), getting each distinct key once.
+        """
+        model = field.rel.to
+        if field.rel.get_related_field() is not model._meta.pk:
+            raise DatabaseError("This database backend can only follow "
+                                "relations to primary keys in "
+                                "select_related().")
+        keys = []
+        for entity in entities:
+            key = entity.get(field.column)
+            if key is not None and not isinstance(key, Key):
+                key = Key.from_path(model._meta.db_table, key)
+            keys.append(key)
+
+        distinct = list(set(key for key in keys if key is not None))
+        compiler = model._base_manager.using(self.using).all().query \
+            .get_compiler(self.using)
+        gae_query = compiler.build_query()
+        found = {}
+        for chunk in gae_query._get_chunks(distinct):
+            for entity in chunk:
+                if entity is not None:
+                    found[entity.key()] = gae_query._make_entity(entity)
+        return [found.get(key) for key in keys]
+
+    def _get_klass_fields(self, klass_info):
+        klass, field_names = klass_info[:2]
+        if not field_names:
+            return klass._meta.fields
+        field_names = set(field_names)
+        return [field for field in klass._meta.fields
+                if field.attname in field_names]
+
+    def _get_klass_width(self, klass_info):
+        """
+        Returns the number of row values used by an object selected
+        with select_related() and objects selected through it.
+        """
+        return klass_info[2] + sum(
+            self._get_klass_width(related_info)
+            for _, related_info in klass_info[3]
+            if related_info is not None)
+
 
 class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
 
-    def execute_sql(self, *a, **kw):
+    def execute_sql(self, return_id=False):
         try:
-            return super(SQLInsertCompiler, self).execute_sql(*a, **kw)
+            return self._execute_sql(return_id)
         except InvalidGaeKey:
             raise DatabaseError("Ivalid value for a key filter on GAE.")
 
+    def _execute_sql(self, return_id):
+        """
+        Same as NonrelInsertCompiler.execute_sql, but using converters
+        of the model's insert plan rather than working out field kinds
+        and db_types for each value, and converting objects as their
+        chunks are put (see insert_entities).
+
+        Objects inserted together (by QuerySet.bulk_create) also get
+        their primary keys set.
+        """
+        plan = get_insert_plan(self.query.model, self.connection)
+        fields = [(field, field.column, plan.converters.get(field))
+                  for field in self.query.fields]
+        raw = self.query.raw
+        objs = self.query.objs
+
+        def to_insert():
+            for obj in objs:
+                field_values = {}
+                for field, column, convert in fields:
+                    if raw:
+                        value = getattr(obj, field.attname)
+                    else:
+                        value = field.pre_save(obj, obj._state.adding)
+                    value = field.get_db_prep_save(
+                        value, connection=self.connection)
+                    if value is None and not field.null and \
+                            not field.primary_key:
+                        raise IntegrityError(
+                            "You can't set %s (a non-nullable field) to "
+                            "None!" % field.name)
+                    if convert is None:
+                        value = self.ops.value_for_db(value, field)
+                    else:
+                        value = convert(value)
+                    field_values[column] = value
+                yield field_values
+
+        keys = self.insert_entities(to_insert())
+
+        pk_field = self.query.get_meta().pk
+        pks = [self.ops.convert_values(
+            self.ops.value_from_db(key, pk_field), pk_field) for key in keys]
+        if len(objs) > 1:
+            for obj, pk in zip(objs, pks):
+                if obj.pk is None:
+                    setattr(obj, pk_field.attname, pk)
+        return pks[0]
+
     @safe_call
     def insert(self, data_list, return_id=False):
-        opts = self.query.get_meta()
-        unindexed_fields = get_model_indexes(self.query.model)['unindexed']
-        unindexed_cols = [opts.get_field(name).column
-                          for name in unindexed_fields]
+        return self.insert_entities(data_list)[0]
 
+    @instrumented('insert')
+    @safe_call
+    def insert_entities(self, data_list):
+        """
+        Puts entities with the given property values (an iterable of
+        dicts by column), returning their keys.
+
+        Entities are built and put in chunks of PUT_CHUNK_SIZE, with no
+        more than MAX_CONCURRENT_RPCS Put RPCs in flight, so chunks
+        are put while the following ones are being converted (and
+        chunks put before an error is met stay written). Outside of
+        transactions entities are added to the write buffer instead if
+        write-behind is active (see db.writes); inside of them they
+        replace buffered entities with the same keys.
+        """
+        plan = get_insert_plan(self.query.model, self.connection)
+        settings_dict = self.connection.settings_dict
+        chunk_size = settings_dict.get('PUT_CHUNK_SIZE',
+                                       DEFAULT_PUT_CHUNK_SIZE)
+        cached = cache.entity_cache_enabled(self.query.model,
+                                            self.connection)
+        chunks = (self._make_entities(plan, data, cached)
+                  for data in chunked(data_list, chunk_size))
+
+        keys = []
+        buffer = writes.get_write_buffer()
+        if buffer is not None and not IsInTransaction():
+            for entities, ancestor_keys, _ in chunks:
+                chunk_keys = buffer.put(entities, cached)
+                self._set_ancestor_ids(ancestor_keys, chunk_keys)
+                keys.extend(chunk_keys)
+            return keys
+
+        def put_chunk(chunk):
+            entities, _, cached_keys = chunk
+            if buffer is not None:
+                # Flushing would overwrite the transaction's writes.
+                buffer.discard([entity.key() for entity in entities])
+            if cached_keys:
+                cache.lock(cached_keys)
+            return PutAsync(entities)
+
+        for (_, ancestor_keys, cached_keys), chunk_keys in \
+                run_concurrently(put_chunk, chunks, settings_dict.get(
+                    'MAX_CONCURRENT_RPCS', DEFAULT_MAX_CONCURRENT_RPCS)):
+            if cached_keys:
+                cache.invalidate(cached_keys)
+            context.evict(chunk_keys)
+            self._set_ancestor_ids(ancestor_keys, chunk_keys)
+            keys.extend(chunk_keys)
+        return keys
+
+    def _make_entities(self, plan, data_list, cached):
+        """
+        Returns entities for a chunk of property dicts, AncestorKeys
+        of their primary keys, and keys of entities that may replace
+        cached ones.
+        """
         entity_list = []
         ancestor_keys = []
         for data in data_list:
             properties = {}
-            kwds = {'unindexed_properties': unindexed_cols}
+            kwds = {'unindexed_properties': plan.unindexed_columns}
             for column, value in data.items():
                 # The value will already be a db.Key, but the Entity
                 # constructor takes a name or id of the key, and will
                 # automatically create a new key if neither is given.
-                if column == opts.pk.column:
+                if column == plan.pk_column:
                     if value is not None:
                         if isinstance(value, AncestorKey):
                             ancestor_keys.append(value)
@@ -548,41 +1239,222 @@ class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
                 else:
                     properties[column] = value
 
-            entity = Entity(opts.db_table, **kwds)
+            entity = Entity(plan.db_table, **kwds)
             entity.update(properties)
             entity_list.append(entity)
 
-        keys = Put(entity_list)
+        cached_keys = []
+        if cached:
+            cached_keys = [entity.key() for entity in entity_list
+                           if entity.key().has_id_or_name()]
+        return entity_list, ancestor_keys, cached_keys
+
+    def _set_ancestor_ids(self, ancestor_keys, keys):
         if ancestor_keys and len(ancestor_keys) == len(keys):
             for ancestor_key, key in zip(ancestor_keys, keys):
                 ancestor_key.key_id = key.id_or_name()
 
-        return keys[0] if isinstance(keys, list) else keys
-
 
 class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
+    """
+    Updates entities matching the query in batches, reading each of
+    them only once.
+
+    By default matching keys are taken from a keys-only query (or the
+    primary key lookup) and each entity group is updated in its own
+    transaction (getting entities and re-checking filters in it), with
+    transactions for different groups running concurrently. With the
+    update_transactional option set to False (see
+    db.utils.update_entities), or inside a transaction, entities
+    returned by the query (or the batch Gets of a primary key lookup)
+    are updated as they are and written back with concurrent batch
+    Puts, so (outside of transactions) concurrent writes may be lost.
+    Matching keys or entities are always collected before anything is
+    written, so entities moved forward in the index being scanned by an
+    update aren't updated again.
+
+    Numbers of updated entities, entities skipped (because they no
+    longer matched the filters or were deleted), and transaction
+    retries are set as the query's _gae_update_stats.
+    """
 
+    @instrumented('update')
     def execute_sql(self, result_type=MULTI):
-        # Modify query to fetch pks only and then execute the query
-        # to get all pks.
-        pk_field = self.query.model._meta.pk
-        self.query.add_immediate_loading([pk_field.name])
-        pks = [row for row in self.results_iter()]
-        self.update_entities(pks, pk_field)
-        return len(pks)
-
-    def update_entities(self, pks, pk_field):
-        for pk in pks:
-            self.update_entity(pk[0], pk_field)
-
-    @commit_locked
-    def update_entity(self, pk, pk_field):
-        gae_query = self.build_query()
-        entity = Get(self.ops.value_for_db(pk, pk_field))
-
-        if not gae_query.matches_filters(entity):
-            return
+        # Updates must not be overwritten by buffered entities.
+        writes.flush()
+
+        incremented = self._increment_counters()
+        if incremented is not None and not self.query.values:
+            self.query._gae_update_stats = {'updated': incremented,
+                                            'skipped': 0, 'retried': 0}
+            return incremented
+
+        config = getattr(self.query, '_gae_config', {})
+        stats = {'updated': 0, 'skipped': 0, 'retried': 0}
+        chunk_size = self.connection.settings_dict.get(
+            'GET_CHUNK_SIZE', DEFAULT_GET_CHUNK_SIZE)
+
+        if config.get('update_transactional', True) and \
+                not IsInTransaction():
+            gae_query = self.build_query([self.query.model._meta.pk])
+            keys = self._get_matching_keys(gae_query)
+            retries = config.get('update_retries', DEFAULT_UPDATE_RETRIES)
+            tasklets = (self._update_group(gae_query, chunked(group,
+                                                              chunk_size),
+                                           retries, stats)
+                        for group in self._group_keys(keys))
+        else:
+            gae_query = self.build_query()
+            if gae_query.included_pks is not None:
+                # Primary key lookups get entities with batch Gets.
+                chunks = chunked(self._get_matching_keys(gae_query),
+                                 chunk_size)
+            else:
+                chunks = chunked(list(gae_query.fetch_entities(
+                    self.query.low_mark, self.query.high_mark)), chunk_size)
+            tasklets = (self._update_chunk(gae_query, chunk, stats)
+                        for chunk in chunks)
+        run_tasklets(tasklets, gae_query._max_concurrent_rpcs())
 
+        self.query._gae_update_stats = stats
+        return stats['updated']
+
+    def _increment_counters(self):
+        """
+        Takes F() increments of ShardedCounterFields out of the update's
+        values (outside of transactions), adding them to the counters
+        of matching entities. Returns the number of matching entities,
+        or None if there are no such increments.
+        """
+        if IsInTransaction():
+            return None
+        increments = []
+        values = []
+        for field, model, value in self.query.values:
+            delta = self._get_counter_increment(field, value)
+            if delta is None:
+                values.append((field, model, value))
+            else:
+                increments.append((field, delta))
+        if not increments:
+            return None
+
+        self.query.values = values
+        gae_query = self.build_query([self.query.model._meta.pk])
+        keys = [entity if isinstance(entity, Key) else entity.key()
+                for entity in gae_query.fetch_entities(
+                    self.query.low_mark, self.query.high_mark)]
+        for key in keys:
+            for field, delta in increments:
+                counters.increment(key, field.column, delta, field.shards)
+        return len(keys)
+
+    def _get_counter_increment(self, field, value):
+        """
+        Returns n for F(field) + n (or -n for F(field) - n) values of
+        sharded counter fields, or None for other values.
+        """
+        if not isinstance(field, ShardedCounterField) or \
+                not isinstance(value, ExpressionNode) or \
+                isinstance(value, F) or len(value.children) != 2:
+            return None
+        first, second = value.children
+        if value.connector == ExpressionNode.ADD and \
+                isinstance(first, (int, long)):
+            first, second = second, first
+        if not isinstance(first, F) or first.name != field.name or \
+                not isinstance(second, (int, long)) or \
+                isinstance(second, bool):
+            return None
+        if value.connector == ExpressionNode.ADD:
+            return second
+        if value.connector == ExpressionNode.SUB:
+            return -second
+        return None
+
+    def _group_keys(self, keys):
+        """
+        Groups keys by their entity groups (keeping their order).
+        """
+        groups = {}
+        order = []
+        for key in keys:
+            root = key
+            while root.parent() is not None:
+                root = root.parent()
+            if root not in groups:
+                groups[root] = []
+                order.append(root)
+            groups[root].append(key)
+        return [groups[root] for root in order]
+
+    def _update_group(self, gae_query, chunks, retries, stats):
+        """
+        Updates chunks of keys from a single entity group, each in a
+        separate transaction, retrying transactions that fail because
+        of concurrent writes.
+        """
+        for keys in chunks:
+            for attempt in xrange(retries + 1):
+                connection = _GetConnection().new_transaction(
+                    TransactionOptions())
+                entities = yield connection.async_get(None, keys)
+                entities = self._update_entities(gae_query, entities)
+                if entities:
+                    self._lock(entities)
+                    connection.async_put(None, entities)
+                committed = yield connection.async_commit(None)
+                if committed is not False:
+                    break
+                stats['retried'] += 1
+            else:
+                raise TransactionFailedError(
+                    "The transaction could not be committed. Please try "
+                    "again.")
+            self._written(entities)
+            stats['updated'] += len(entities)
+            stats['skipped'] += len(keys) - len(entities)
+
+    def _get_matching_keys(self, gae_query):
+        """
+        Returns keys of the primary key lookup or of the keys-only
+        query's results.
+        """
+        if gae_query.included_pks is not None:
+            return [key for key in gae_query.included_pks
+                    if key not in gae_query.excluded_pks]
+        return list(gae_query.fetch_entities(self.query.low_mark,
+                                             self.query.high_mark))
+
+    def _update_chunk(self, gae_query, chunk, stats):
+        """
+        Updates and writes back a chunk of the matching entities,
+        getting them first if the chunk holds their keys.
+        """
+        entities = chunk
+        if chunk and isinstance(chunk[0], Key):
+            entities = yield GetAsync(chunk)
+        updated = self._update_entities(gae_query, entities)
+        if updated:
+            self._lock(updated)
+            yield PutAsync(updated)
+            self._written(updated)
+        stats['updated'] += len(updated)
+        stats['skipped'] += len(chunk) - len(updated)
+
+    def _update_entities(self, gae_query, entities):
+        """
+        Sets new values on entities that still exist and match the
+        query's filters, returning them.
+        """
+        entities = [entity for entity in entities
+                    if entity is not None and
+                    gae_query.matches_filters(entity)]
+        for entity in entities:
+            self._update_values(entity)
+        return entities
+
+    def _update_values(self, entity):
         for field, _, value in self.query.values:
             if hasattr(value, 'prepare_database_save'):
                 value = value.prepare_database_save(field)
@@ -601,7 +1473,15 @@ class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
 
             entity[field.column] = self.ops.value_for_db(value, field)
 
-        Put(entity)
+    def _lock(self, entities):
+        if cache.entity_cache_enabled(self.query.model, self.connection):
+            cache.lock([entity.key() for entity in entities])
+
+    def _written(self, entities):
+        keys = [entity.key() for entity in entities]
+        if cache.entity_cache_enabled(self.query.model, self.connection):
+            cache.invalidate(keys)
+        context.evict(keys)
 
 
 class SQLDeleteCompiler(NonrelDeleteCompiler, SQLCompiler):
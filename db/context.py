@@ -0,0 +1,88 @@
+from collections import OrderedDict
+import threading
+
+
+# Number of entities kept by the context cache of a request (unless set
+# through the CONTEXT_CACHE_SIZE database option).
+DEFAULT_CONTEXT_CACHE_SIZE = 1000
+
+_local = threading.local()
+
+
+class ContextCache(object):
+    """
+    Keeps datastore entities fetched during a request by their keys,
+    evicting the least recently used ones above max_size entities.
+    """
+
+    def __init__(self, max_size=DEFAULT_CONTEXT_CACHE_SIZE):
+        self.max_size = max_size
+        self.entities = OrderedDict()
+
+    def get_multi(self, keys):
+        """
+        Returns a dict with entities cached for any of the given keys.
+        """
+        found = {}
+        for key in keys:
+            entity = self.entities.pop(key, None)
+            if entity is not None:
+                self.entities[key] = entity
+                found[key] = entity
+        return found
+
+    def add(self, entities):
+        for entity in entities:
+            if entity is None:
+                continue
+            key = entity.key()
+            self.entities.pop(key, None)
+            self.entities[key] = entity
+        while len(self.entities) > self.max_size:
+            self.entities.popitem(last=False)
+
+    def evict(self, keys):
+        for key in keys:
+            self.entities.pop(key, None)
+
+    def clear(self):
+        self.entities.clear()
+
+
+def activate(max_size=DEFAULT_CONTEXT_CACHE_SIZE):
+    """
+    Starts caching entities for the current thread (e.g. while handling
+    a request, see ContextCacheMiddleware).
+    """
+    _local.cache = ContextCache(max_size)
+
+
+def deactivate():
+    _local.cache = None
+
+
+def get_context_cache():
+    """
+    Returns the current thread's ContextCache or None if it's not
+    active.
+    """
+    return getattr(_local, 'cache', None)
+
+
+def get_entities(keys):
+    cache = get_context_cache()
+    if cache is None:
+        return {}
+    return cache.get_multi(keys)
+
+
+def add_entities(entities):
+    cache = get_context_cache()
+    if cache is not None:
+        cache.add(entities)
+
+
+def evict(keys):
+    cache = get_context_cache()
+    if cache is not None:
+        cache.evict(keys)
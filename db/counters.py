@@ -0,0 +1,160 @@
+"""
+Sharded counters: increments of a counter are buffered in memcache and
+periodically added (by deferred tasks) to one of several shard
+entities, each in its own entity group, so hot counters aren't limited
+by the write rate of a single entity group. Totals are cached.
+
+Counters are identified by the key of the entity they belong to and a
+property name (see fields.ShardedCounterField). Note that increments
+buffered in memcache can be lost if they are evicted before being
+flushed.
+"""
+import random
+
+from google.appengine.api import memcache
+from google.appengine.api.datastore import Entity, Get, Put, \
+    RunInTransaction
+from google.appengine.api.datastore_types import Key
+
+
+# Kind of shard entities.
+SHARD_KIND = '_djangoappengine_counter_shard'
+
+# Prefix of memcache keys of buffered increments, cached totals, flush
+# markers and numbers of flushes started and finished.
+KEY_PREFIX = 'djangoappengine:counter:'
+
+# Number of shard entities of a counter (unless given by its field).
+DEFAULT_SHARDS = 20
+
+# Number of seconds increments are buffered before being flushed.
+FLUSH_DELAY = 10
+
+# Number of seconds totals are cached (increments made through this
+# module also update the cached totals).
+TOTAL_CACHE_TIME = 60
+
+
+def counter_name(key, name):
+    return '%s:%s' % (key, name)
+
+
+def shard_keys(counter, shards=DEFAULT_SHARDS):
+    return [Key.from_path(SHARD_KIND, '%s:%d' % (counter, index))
+            for index in xrange(shards)]
+
+
+def _buffer_key(counter):
+    return KEY_PREFIX + 'buffer:' + counter
+
+
+def _total_key(counter):
+    return KEY_PREFIX + 'total:' + counter
+
+
+def _flush_key(counter):
+    return KEY_PREFIX + 'flush:' + counter
+
+
+def _flushes_key(counter):
+    return KEY_PREFIX + 'flushes:' + counter
+
+
+def increment(key, name, delta=1, shards=DEFAULT_SHARDS):
+    """
+    Adds delta to the counter name of the entity with the given key.
+
+    Positive increments are buffered in memcache and flushed to a
+    random shard by a deferred task (a single one for all increments
+    made within FLUSH_DELAY seconds). Decrements (and increments that
+    can't be buffered) are written to a shard right away.
+    """
+    if delta == 0:
+        return
+    counter = counter_name(key, name)
+    if delta < 0 or memcache.incr(_buffer_key(counter), delta,
+                                  initial_value=0) is None:
+        add_to_shard(counter, delta, shards)
+    elif memcache.add(_flush_key(counter), 1, time=FLUSH_DELAY):
+        from google.appengine.ext import deferred
+        deferred.defer(flush, counter, shards, _countdown=FLUSH_DELAY)
+
+    if delta > 0:
+        memcache.incr(_total_key(counter), delta)
+    else:
+        memcache.delete(_total_key(counter))
+
+
+def add_to_shard(counter, delta, shards=DEFAULT_SHARDS):
+    """
+    Adds delta to a random shard of the counter in a transaction.
+    """
+    key = random.choice(shard_keys(counter, shards))
+
+    def txn():
+        entity = Get([key])[0]
+        if entity is None:
+            entity = Entity(SHARD_KIND, name=key.name(),
+                            unindexed_properties=('count',))
+            entity['count'] = 0
+        entity['count'] += delta
+        Put(entity)
+    RunInTransaction(txn)
+
+
+def flush(counter, shards=DEFAULT_SHARDS):
+    """
+    Moves increments buffered for the counter to one of its shards
+    (run by deferred tasks). The buffer is taken atomically, so
+    increments made meanwhile are left for the next flush, which they
+    schedule as the flush marker is removed first.
+
+    The flushes counter is odd while a flush is in progress, so totals
+    read meanwhile (which may miss the increments being moved) aren't
+    cached.
+    """
+    memcache.delete(_flush_key(counter))
+    flushes_key = _flushes_key(counter)
+    memcache.incr(flushes_key, initial_value=0)
+    try:
+        _flush_buffer(counter, shards)
+    finally:
+        memcache.incr(flushes_key, initial_value=0)
+
+
+def _flush_buffer(counter, shards):
+    client = memcache.Client()
+    buffer_key = _buffer_key(counter)
+    while True:
+        delta = client.gets(buffer_key)
+        if not delta:
+            return
+        if client.cas(buffer_key, 0):
+            break
+
+    try:
+        add_to_shard(counter, int(delta), shards)
+    except:
+        memcache.incr(buffer_key, int(delta), initial_value=0)
+        raise
+
+
+def get_count(key, name, shards=DEFAULT_SHARDS):
+    """
+    Returns the total of the counter name of the entity with the given
+    key: its cached total, or the sum of its shards and buffered
+    increments (which is then cached, unless a flush ran meanwhile).
+    """
+    counter = counter_name(key, name)
+    total = memcache.get(_total_key(counter))
+    if total is None:
+        flushes_key = _flushes_key(counter)
+        flushes = memcache.get(flushes_key)
+        total = sum(entity['count'] for entity in
+                    Get(shard_keys(counter, shards)) if entity is not None)
+        total += int(memcache.get(_buffer_key(counter)) or 0)
+        if not (flushes or 0) % 2 and \
+                memcache.get(flushes_key) == flushes:
+            memcache.add(_total_key(counter), total,
+                         time=TOTAL_CACHE_TIME)
+    return int(total)
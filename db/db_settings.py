@@ -12,6 +12,8 @@ _MODULE_NAMES = getattr(settings, 'GAE_SETTINGS_MODULES', ())
 
 FIELD_INDEXES = None
 
+ENTITY_CACHE = None
+
 
 def get_model_indexes(model):
     indexes = get_indexes()
@@ -23,11 +25,57 @@ def get_model_indexes(model):
     return model_index
 
 
+class FieldIndexes(dict):
+    """
+    Index definitions by model, counting changes (so that anything
+    computed from them can be rebuilt when they change).
+    """
+    version = 0
+
+    def _changed(method):
+        def _method(self, *args, **kwargs):
+            self.version += 1
+            return method(self, *args, **kwargs)
+        return _method
+
+    __setitem__ = _changed(dict.__setitem__)
+    __delitem__ = _changed(dict.__delitem__)
+    clear = _changed(dict.clear)
+    pop = _changed(dict.pop)
+    popitem = _changed(dict.popitem)
+    setdefault = _changed(dict.setdefault)
+    update = _changed(dict.update)
+    del _changed
+
+
 def get_indexes():
     global FIELD_INDEXES
     if FIELD_INDEXES is None:
-        field_indexes = {}
+        field_indexes = FieldIndexes()
         for name in _MODULE_NAMES:
             field_indexes.update(import_module(name).FIELD_INDEXES)
         FIELD_INDEXES = field_indexes
     return FIELD_INDEXES
+
+
+def get_model_entity_cache(model):
+    """
+    Returns True or False if entities of the model (or one of its
+    bases) were opted in or out of the entity cache, None otherwise.
+    """
+    entity_cache = get_entity_cache()
+    for item in model.mro():
+        if item in entity_cache:
+            return entity_cache[item]
+    return None
+
+
+def get_entity_cache():
+    global ENTITY_CACHE
+    if ENTITY_CACHE is None:
+        entity_cache = {}
+        for name in _MODULE_NAMES:
+            entity_cache.update(getattr(import_module(name),
+                                        'ENTITY_CACHE', {}))
+        ENTITY_CACHE = entity_cache
+    return ENTITY_CACHE
@@ -0,0 +1,148 @@
+import datetime
+import decimal
+
+from django.db.models.fields import NOT_PROVIDED
+from django.db.utils import IntegrityError
+
+from google.appengine.api.datastore_types import Key
+
+from djangotoolbox.db.base import NonrelDatabaseOperations
+
+
+# Row decoders by model, selected columns and database alias.
+_DECODERS = {}
+MAX_CACHED_DECODERS = 500
+
+# Number of fetched entities decoded together.
+DECODE_BATCH_SIZE = 100
+
+# Field kinds deconverted by djangotoolbox (recursively or by
+# unpickling), which decoders leave to _value_from_db.
+GENERIC_KINDS = ('ListField', 'SetField', 'DictField', 'EmbeddedModelField')
+
+
+class RowDecoder(object):
+    """
+    Turns entities into rows of values for the given fields, doing
+    what _make_result does using value_from_db and convert_values, but
+    with conversions for each column chosen once, and decoding batches
+    of entities a column at a time.
+    """
+
+    def __init__(self, fields, connection):
+        self.columns = []
+        for field in fields:
+            self.columns.append((field.column, field,
+                                 self._make_decoder(field, connection)))
+
+    def _make_decoder(self, field, connection):
+        """
+        Returns a function deconverting a (non-None) value stored for
+        the field, or None if the value can be used as it is.
+        """
+        from .base import DatabaseOperations
+
+        ops = connection.ops
+        converted_field, field_kind, db_type = ops._convert_as(field)
+
+        def generic(value):
+            return ops._value_from_db(value, converted_field, field_kind,
+                                      db_type)
+
+        convert_values = None
+        if getattr(ops.convert_values, 'im_func', None) is not \
+                NonrelDatabaseOperations.convert_values.im_func:
+            convert_values = lambda value: ops.convert_values(value, field)
+
+        if getattr(ops._value_from_db, 'im_func', None) is not \
+                DatabaseOperations._value_from_db.im_func or \
+                field_kind in GENERIC_KINDS:
+            decode = generic
+        else:
+            decode = self._make_gae_decoder(ops, field_kind, db_type,
+                                            generic)
+
+        if convert_values is None:
+            return decode
+        if decode is None:
+            return convert_values
+        return lambda value: convert_values(decode(value))
+
+    def _make_gae_decoder(self, ops, field_kind, db_type, generic):
+        """
+        Picks the part of DatabaseOperations._value_from_db needed for
+        the db_type and field kind.
+        """
+        epoch = ops.EPOCH
+        timedelta = datetime.timedelta
+
+        # Projection queries return date / time values as they are
+        # indexed (microseconds since the epoch).
+        def to_datetime(value):
+            if isinstance(value, (int, long)):
+                return epoch + timedelta(microseconds=value)
+            return value
+
+        decode = None
+        if db_type == 'key':
+            def decode(value):
+                if type(value) is not Key or value.parent():
+                    return generic(value)
+                return value.id_or_name()
+        elif db_type in ('string', 'text'):
+            def decode(value):
+                if isinstance(value, str):
+                    return value.decode('utf-8')
+                return unicode(value)
+        elif db_type == 'date':
+            decode = lambda value: to_datetime(value).date()
+        elif db_type == 'time':
+            decode = lambda value: to_datetime(value).time()
+        elif db_type == 'datetime':
+            decode = to_datetime
+        elif db_type == 'bytes':
+            decode = str
+
+        if field_kind == 'DecimalField':
+            if decode is None:
+                return decimal.Decimal
+            return lambda value: decimal.Decimal(decode(value))
+        return decode
+
+    def decode(self, entities):
+        """
+        Returns a list of row tuples for a batch of entities.
+        """
+        columns = []
+        for column, field, decode in self.columns:
+            values = [entity.get(column, NOT_PROVIDED)
+                      for entity in entities]
+            if decode is not None:
+                values = [value if value is None or value is NOT_PROVIDED
+                          else decode(value) for value in values]
+            # Values are only compared by identity, as some types (e.g.
+            # AncestorKey) can't be compared with anything.
+            if any(value is NOT_PROVIDED for value in values):
+                values = [field.get_default() if value is NOT_PROVIDED
+                          else value for value in values]
+            if not field.null and any(value is None for value in values):
+                raise IntegrityError("Non-nullable field %s can't be None!" %
+                                     field.name)
+            columns.append(values)
+        if not columns:
+            return [() for entity in entities]
+        return zip(*columns)
+
+
+def get_row_decoder(model, fields, connection):
+    """
+    Returns a RowDecoder for the fields of the model, creating it the
+    first time the fields are selected.
+    """
+    key = (model, tuple(field.column for field in fields), connection.alias)
+    decoder = _DECODERS.get(key)
+    if decoder is None:
+        if len(_DECODERS) >= MAX_CACHED_DECODERS:
+            _DECODERS.clear()
+        decoder = _DECODERS[key] = RowDecoder(fields, connection)
+    return decoder
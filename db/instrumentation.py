@@ -0,0 +1,249 @@
+from functools import wraps
+import logging
+import threading
+import time
+from types import GeneratorType
+
+from django.dispatch import Signal
+
+from google.appengine.api import apiproxy_stub_map
+
+
+# Sent after each datastore RPC, with the RPC method (e.g. 'Get' or
+# 'RunQuery'), the number of entities (or keys) it carried, the sizes
+# of its request and response and the time it took (in seconds).
+rpc_completed = Signal(providing_args=['call', 'entities', 'bytes',
+                                       'duration'])
+
+# Sent after each query operation (fetch, count, delete, insert or
+# update) with the model as the sender, the Django query, the time
+# spent in the backend and whether filters had to be checked or
+# results sorted in memory.
+query_completed = Signal(providing_args=['query', 'operation', 'duration',
+                                         'emulated_filter',
+                                         'in_memory_sort'])
+
+HOOK_NAME = 'djangoappengine_instrumentation'
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    """
+    Datastore usage of a request: RPCs by method (with numbers of
+    entities, bytes sent and received and time spent), and numbers of
+    query operations and of queries that needed emulated filtering or
+    in-memory sorting.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.queries = 0
+        self.emulated_filters = 0
+        self.in_memory_sorts = 0
+        self.slow_queries = 0
+
+    def add_rpc(self, call, entities, size, duration):
+        totals = self.calls.get(call)
+        if totals is None:
+            totals = self.calls[call] = {'count': 0, 'entities': 0,
+                                         'bytes': 0, 'time': 0.0}
+        totals['count'] += 1
+        totals['entities'] += entities
+        totals['bytes'] += size
+        totals['time'] += duration
+
+    def add_query(self, emulated_filter, in_memory_sort, slow):
+        self.queries += 1
+        self.emulated_filters += emulated_filter
+        self.in_memory_sorts += in_memory_sort
+        self.slow_queries += slow
+
+    @property
+    def rpcs(self):
+        return sum(totals['count'] for totals in self.calls.itervalues())
+
+    def summary(self):
+        return {
+            'rpcs': self.rpcs,
+            'calls': dict((call, dict(totals))
+                          for call, totals in self.calls.iteritems()),
+            'queries': self.queries,
+            'emulated_filters': self.emulated_filters,
+            'in_memory_sorts': self.in_memory_sorts,
+            'slow_queries': self.slow_queries,
+        }
+
+    def format(self):
+        """
+        Returns the summary as a single line (e.g. for a header).
+        """
+        parts = ['rpcs=%d' % self.rpcs]
+        for call in sorted(self.calls):
+            totals = self.calls[call]
+            parts.append('%s=%d/%de/%db/%dms' % (
+                call, totals['count'], totals['entities'], totals['bytes'],
+                totals['time'] * 1000))
+        parts.append('queries=%d' % self.queries)
+        if self.emulated_filters:
+            parts.append('emulated_filters=%d' % self.emulated_filters)
+        if self.in_memory_sorts:
+            parts.append('in_memory_sorts=%d' % self.in_memory_sorts)
+        if self.slow_queries:
+            parts.append('slow_queries=%d' % self.slow_queries)
+        return ' '.join(parts)
+
+
+def activate():
+    """
+    Starts recording datastore usage of the current thread (e.g. while
+    handling a request, see main.DjangoAppEngineMiddleware).
+    """
+    install_hooks()
+    _local.stats = RequestStats()
+
+
+def deactivate():
+    """
+    Stops recording, returning the RequestStats recorded so far (or
+    None if recording wasn't active).
+    """
+    stats = get_request_stats()
+    _local.stats = None
+    return stats
+
+
+def get_request_stats():
+    """
+    Returns the current thread's RequestStats or None if datastore
+    usage isn't being recorded.
+    """
+    return getattr(_local, 'stats', None)
+
+
+def install_hooks():
+    """
+    Adds RPC hooks to the current API proxy (testbeds replace it), so
+    RPCs are recorded and rpc_completed is sent. Installing the hooks
+    again is a no-op.
+    """
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append(HOOK_NAME, _pre_call, 'datastore_v3')
+    apiproxy.GetPostCallHooks().Append(HOOK_NAME, _post_call,
+                                       'datastore_v3')
+
+
+def _recording_rpcs():
+    return get_request_stats() is not None or \
+        bool(rpc_completed.receivers)
+
+
+def _pre_call(service, call, request, response):
+    if _recording_rpcs():
+        started = getattr(_local, 'started', None)
+        if started is None:
+            started = _local.started = {}
+        started[id(request)] = time.time()
+
+
+def _post_call(service, call, request, response, rpc=None, error=None):
+    started = getattr(_local, 'started', {}).pop(id(request), None)
+    if started is None or not _recording_rpcs():
+        return
+    duration = time.time() - started
+    entities = _count_entities(call, request, response, error)
+    size = _byte_size(request)
+    if error is None:
+        size += _byte_size(response)
+
+    stats = get_request_stats()
+    if stats is not None:
+        stats.add_rpc(call, entities, size, duration)
+    rpc_completed.send(sender=None, call=call, entities=entities,
+                       bytes=size, duration=duration)
+
+
+def _count_entities(call, request, response, error):
+    if call in ('Get', 'Delete'):
+        return request.key_size()
+    if call == 'Put':
+        return request.entity_size()
+    if call in ('RunQuery', 'Next') and error is None:
+        return response.result_size()
+    return 0
+
+
+def _byte_size(message):
+    try:
+        return message.ByteSize()
+    except Exception:
+        return 0
+
+
+def _recording_queries(connection):
+    return get_request_stats() is not None or \
+        bool(query_completed.receivers) or \
+        connection.settings_dict.get('SLOW_QUERY_THRESHOLD') is not None
+
+
+def instrumented(operation):
+    """
+    Records the time spent in the decorated query operation (a method
+    of an object with query and connection attributes, possibly
+    returning a generator, in which case only time spent producing
+    results counts), whether it used emulated filtering or in-memory
+    sorting (the emulated_filter and in_memory_sort attributes), and
+    logs it if it took longer than the SLOW_QUERY_THRESHOLD database
+    option (in seconds).
+    """
+
+    def decorator(func):
+
+        @wraps(func)
+        def _func(self, *args, **kwargs):
+            if not _recording_queries(self.connection):
+                return func(self, *args, **kwargs)
+            started = time.time()
+            result = func(self, *args, **kwargs)
+            duration = time.time() - started
+            if isinstance(result, GeneratorType):
+                return _timed(self, operation, result, duration)
+            record_query(self, operation, duration)
+            return result
+        return _func
+    return decorator
+
+
+def _timed(instance, operation, results, duration):
+    try:
+        while True:
+            started = time.time()
+            try:
+                result = results.next()
+            except StopIteration:
+                return
+            finally:
+                duration += time.time() - started
+            yield result
+    finally:
+        record_query(instance, operation, duration)
+
+
+def record_query(instance, operation, duration):
+    emulated_filter = getattr(instance, 'emulated_filter', False)
+    in_memory_sort = getattr(instance, 'in_memory_sort', False)
+    query = instance.query
+    threshold = instance.connection.settings_dict.get('SLOW_QUERY_THRESHOLD')
+    slow = threshold is not None and duration >= threshold
+    if slow:
+        logging.warning("Slow datastore %s (%.3fs) on %s: %r WHERE %s" % (
+            operation, duration, query.model._meta.db_table, instance,
+            query.where))
+
+    stats = get_request_stats()
+    if stats is not None:
+        stats.add_query(emulated_filter, in_memory_sort, slow)
+    query_completed.send(sender=query.model, query=query,
+                         operation=operation, duration=duration,
+                         emulated_filter=emulated_filter,
+                         in_memory_sort=in_memory_sort)
@@ -0,0 +1,109 @@
+from collections import deque
+import heapq
+
+from .batch import DEFAULT_MAX_CONCURRENT_RPCS
+from .ordering import entity_key, make_sort_key
+
+
+# Number of sub-queries the SDK's MultiQuery accepts.
+MAX_ROUND_SIZE = 30
+
+
+class ConcurrentMultiQuery(object):
+    """
+    Replacement for the SDK's MultiQuery that runs sub-queries
+    concurrently (each Run() issues its first batch RPC asynchronously)
+    and lazily merges their results in the requested order, skipping
+    entities already returned by another sub-query.
+
+    No more than max_in_flight sub-queries wait for their first batch
+    at a time; further ones are only started once an earlier one has
+    returned its first batch.
+
+    Note that keys-only sub-queries can only be merged by key.
+    """
+
+    def __init__(self, queries, ordering,
+                 max_in_flight=DEFAULT_MAX_CONCURRENT_RPCS):
+        self.queries = queries
+        self.ordering = ordering
+        self.max_in_flight = max_in_flight
+
+    def __repr__(self):
+        return '<ConcurrentMultiQuery: %r ORDER %r>' % (self.queries,
+                                                        self.ordering)
+
+    def Run(self, offset=0, limit=None, **kwargs):
+        # Each sub-query has to be able to fill the requested slice on
+        # its own, but asks just for its share of it in the first batch
+        # (so first batches together hold about the rows needed). A
+        # sub-query only fetches another batch once its buffered rows
+        # have been merged and its next row is needed.
+        if limit is not None:
+            needed = offset + limit
+            kwargs['limit'] = needed
+            if 'batch_size' not in kwargs and 'prefetch_size' not in kwargs:
+                kwargs['prefetch_size'] = max(
+                    1, -(-needed // len(self.queries)))
+                kwargs['batch_size'] = needed
+        return self._merge(self._start(kwargs), offset, limit)
+
+    def Get(self, limit, offset=0, **kwargs):
+        return list(self.Run(offset=offset, limit=limit, **kwargs))
+
+    def Count(self, limit=None, **kwargs):
+        count = 0
+        for _ in self.Run(limit=limit, **kwargs):
+            count += 1
+        return count
+
+    def _start(self, kwargs):
+        """
+        Runs the sub-queries, returning a (first result, results) pair
+        for each one that returned anything.
+        """
+        heads = []
+        running = deque()
+
+        def wait():
+            results = running.popleft()
+            for entity in results:
+                heads.append((entity, results))
+                break
+
+        for query in self.queries:
+            if len(running) >= self.max_in_flight:
+                wait()
+            running.append(iter(query.Run(**kwargs)))
+        while running:
+            wait()
+        return heads
+
+    def _merge(self, heads, offset, limit):
+        sort_key = make_sort_key(self.ordering)
+
+        heap = [(sort_key(entity), index, entity, results)
+                for index, (entity, results) in enumerate(heads)]
+        heapq.heapify(heap)
+
+        seen = set()
+        while heap and limit != 0:
+            _, index, entity, results = heapq.heappop(heap)
+            key = entity_key(entity)
+            if key not in seen:
+                seen.add(key)
+                if offset:
+                    offset -= 1
+                else:
+                    if limit is not None:
+                        limit -= 1
+                    yield entity
+                    if limit == 0:
+                        return
+
+            # Only advance the sub-query (possibly fetching its next
+            # batch) once its next result is needed.
+            for next_entity in results:
+                heapq.heappush(heap, (sort_key(next_entity), index,
+                                      next_entity, results))
+                break
@@ -0,0 +1,111 @@
+import datetime
+import heapq
+
+from google.appengine.api.datastore import Query
+from google.appengine.api.datastore_types import Key, GeoPt
+from google.appengine.api.users import User
+
+
+# Ranks of value types in the order the datastore sorts them (values of
+# different types never compare by value).
+_TYPE_RANKS = (
+    (bool, 3),
+    ((int, long), 1),
+    (datetime.datetime, 2),
+    (str, 4),
+    (unicode, 5),
+    (float, 6),
+    (GeoPt, 7),
+    (User, 8),
+    (Key, 9),
+)
+
+
+def _rank(value):
+    if value is None:
+        return 0
+    for types, rank in _TYPE_RANKS:
+        if isinstance(value, types):
+            return rank
+    return 10
+
+
+class _Descending(object):
+    """
+    Wraps a sort value inverting its comparisons.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def entity_key(entity):
+    if isinstance(entity, Key):
+        return entity
+    return entity.key()
+
+
+def make_sort_key(ordering):
+    """
+    Returns a function computing a value that sorts entities (or keys
+    for keys-only queries) the same way the datastore orders results
+    for the given list of (column, direction) pairs.
+
+    None comes before any other value and values of different types
+    are ordered by type, as on the datastore. Multi-valued properties
+    are sorted by their smallest value when ascending and by the
+    largest one when descending. Entities are always finally ordered by
+    their keys.
+    """
+    columns = []
+    for column, direction in ordering:
+        columns.append((column, direction == Query.ASCENDING))
+        if column == '__key__':
+            break
+    else:
+        columns.append(('__key__', True))
+
+    def sort_key(entity):
+        values = []
+        for column, ascending in columns:
+            if column == '__key__':
+                value = entity_key(entity)
+            elif isinstance(entity, Key):
+                value = None
+            else:
+                value = entity.get(column)
+
+            if isinstance(value, list) and value:
+                ranked = [(_rank(item), item) for item in value]
+                value = min(ranked) if ascending else max(ranked)
+            else:
+                value = (_rank(value), value)
+
+            if not ascending:
+                value = _Descending(value)
+            values.append(value)
+        return tuple(values)
+    return sort_key
+
+
+def sort_entities(entities, ordering, low_mark=0, high_mark=None):
+    """
+    Returns the [low_mark:high_mark] slice of entities ordered in
+    memory, using a heap when only the first few are needed.
+    """
+    sort_key = make_sort_key(ordering)
+    if high_mark is None:
+        results = sorted(entities, key=sort_key)
+    else:
+        results = heapq.nsmallest(high_mark, entities, key=sort_key)
+    return results[low_mark:]
@@ -0,0 +1,143 @@
+from google.appengine.api.datastore import Query
+
+from .db_settings import get_indexes, get_model_indexes
+
+
+# Query plans by the shape of the filters they were built for.
+_PLANS = {}
+MAX_CACHED_PLANS = 500
+
+_STATS = {'hits': 0, 'misses': 0}
+
+# Insert plans by model and database alias.
+_INSERT_PLANS = {}
+
+
+class QueryPlan(object):
+    """
+    Filters of GAE sub-queries built for a WHERE tree, with references
+    to the lookup values in place of the values themselves.
+
+    Each template is a list of (filter, leaf, index, value) entries; the
+    value is taken from the leaf-th lookup value (or its index-th
+    element, if index is not None) unless leaf is None. Special leaves
+    (primary key, ancestor and empty list lookups) don't add any
+    filters and are just applied again for each query.
+    """
+    __slots__ = ('templates', 'special', 'cursors', 'inequality_field',
+                 'has_negated_exact_filter')
+
+    def __init__(self, templates, special, cursors, inequality_field,
+                 has_negated_exact_filter):
+        self.templates = templates
+        self.special = special
+        self.cursors = cursors
+        self.inequality_field = inequality_field
+        self.has_negated_exact_filter = has_negated_exact_filter
+
+    def bind(self, db_table, values, keys_only=False, cursor=None,
+             end_cursor=None):
+        """
+        Returns a list of datastore Queries with the plan's filters,
+        using the given lookup values.
+        """
+        cursors = {}
+        if self.cursors:
+            cursors = {'cursor': cursor, 'end_cursor': end_cursor}
+        queries = []
+        for template in self.templates:
+            filters = {}
+            for filter, leaf, index, value in template:
+                if leaf is not None:
+                    value = values[leaf]
+                    if index is not None:
+                        value = value[index]
+                if filter in filters:
+                    existing_value = filters[filter]
+                    if isinstance(existing_value, list):
+                        existing_value.append(value)
+                    else:
+                        filters[filter] = [existing_value, value]
+                else:
+                    filters[filter] = value
+            queries.append(Query(db_table, filters, keys_only=keys_only,
+                                 **cursors))
+        return queries
+
+
+def get_plan(key):
+    """
+    Returns the plan cached for the given shape or None, counting cache
+    hits and misses.
+    """
+    plan = _PLANS.get(key)
+    if plan is None:
+        _STATS['misses'] += 1
+    else:
+        _STATS['hits'] += 1
+    return plan
+
+
+def cache_plan(key, plan):
+    if len(_PLANS) >= MAX_CACHED_PLANS:
+        _PLANS.clear()
+    _PLANS[key] = plan
+
+
+def get_plan_cache_stats():
+    """
+    Returns numbers of plan cache hits and misses, and of the currently
+    cached plans.
+    """
+    return dict(_STATS, size=len(_PLANS))
+
+
+def clear_plan_cache():
+    _PLANS.clear()
+    _STATS['hits'] = _STATS['misses'] = 0
+
+
+class InsertPlan(object):
+    """
+    Everything needed to turn field values of a model into entity
+    properties that only depends on the model and database settings:
+    the unindexed columns and a converter doing value_for_db for each
+    field.
+    """
+
+    def __init__(self, model, connection):
+        opts = model._meta
+        ops = connection.ops
+        self.indexes = get_indexes()
+        self.indexes_version = getattr(self.indexes, 'version', None)
+        self.db_table = opts.db_table
+        self.pk_column = opts.pk.column
+        self.unindexed_columns = [
+            opts.get_field(name).column
+            for name in get_model_indexes(model)['unindexed']]
+        self.converters = dict(
+            (field, self._make_converter(ops, *ops._convert_as(field)))
+            for field in opts.fields)
+
+    def _make_converter(self, ops, field, field_kind, db_type):
+        def convert(value):
+            return ops._value_for_db(value, field, field_kind, db_type,
+                                     None)
+        return convert
+
+    def is_current(self):
+        indexes = get_indexes()
+        return indexes is self.indexes and \
+            getattr(indexes, 'version', None) == self.indexes_version
+
+
+def get_insert_plan(model, connection):
+    """
+    Returns the InsertPlan for the model, rebuilding it if index
+    definitions changed since it was created.
+    """
+    key = (model, connection.alias)
+    plan = _INSERT_PLANS.get(key)
+    if plan is None or not plan.is_current():
+        plan = _INSERT_PLANS[key] = InsertPlan(model, connection)
+    return plan
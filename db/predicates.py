@@ -0,0 +1,136 @@
+import datetime
+
+from django.db.models.sql.where import AND
+from django.utils.tree import Node
+
+from google.appengine.api.datastore_types import Key
+
+from djangotoolbox.db.basecompiler import EMULATED_OPS
+
+
+# Lookups never matching entities without a value.
+STRING_LOOKUPS = ('startswith', 'contains', 'endswith', 'iexact',
+                  'istartswith', 'icontains', 'iendswith')
+
+# Compiled predicates by the shape of the constraint tree.
+_PREDICATES = {}
+MAX_CACHED_PREDICATES = 500
+
+
+def bind_where(query, where):
+    """
+    Decodes a WHERE tree for the given GAEQuery, separating its shape
+    (connectors, columns and lookup types) from the lookup values.
+
+    Returns a hashable shape and a list of values, in the order leaves
+    appear in the tree.
+    """
+    values = []
+
+    def bind_node(node):
+        children = []
+        for child in query._get_children(node.children):
+            if isinstance(child, Node):
+                if not child.children:
+                    continue
+                if len(child.children) == 1 and not child.negated:
+                    child = child.children[0]
+                    if not isinstance(child, Node):
+                        children.append(bind_leaf(child))
+                        continue
+                children.append(bind_node(child))
+            else:
+                children.append(bind_leaf(child))
+        return ('node', node.connector, node.negated, tuple(children))
+
+    def bind_leaf(child):
+        field, lookup_type, value = query._decode_child(child)
+
+        if lookup_type == 'ancestor':
+            values.append(Key.from_path(value._meta.db_table, value.pk))
+            return ('leaf', None, lookup_type, True, None)
+
+        # When we have a foreignkey that's a primary key the query might
+        # be filtering on Key('related_model', id), but we're actually
+        # looking up on Key('this_model', id), so compare kindless.
+        if field.primary_key and field.rel and lookup_type == 'exact':
+            value = Key.from_path(field.model._meta.db_table,
+                                  value.id_or_name())
+
+        if isinstance(value, (datetime.datetime, datetime.date,
+                              datetime.time)):
+            none_match = lookup_type in ('lt', 'lte')
+        elif lookup_type in STRING_LOOKUPS:
+            none_match = False
+        else:
+            none_match = None
+
+        values.append(value)
+        return ('leaf', field.column, lookup_type, field.primary_key,
+                none_match)
+
+    return bind_node(where), values
+
+
+def get_predicate(shape):
+    """
+    Returns a function (entity, values) -> bool checking if a datastore
+    Entity satisfies constraints with the given shape for the bound
+    values. Predicates are compiled once for each shape.
+    """
+    try:
+        return _PREDICATES[shape]
+    except KeyError:
+        if len(_PREDICATES) >= MAX_CACHED_PREDICATES:
+            _PREDICATES.clear()
+        predicate = _PREDICATES[shape] = _compile(shape, [0])
+        return predicate
+
+
+def _compile(shape, counter):
+    if shape[0] == 'leaf':
+        index = counter[0]
+        counter[0] += 1
+        return _compile_leaf(index, *shape[1:])
+
+    _, connector, negated, children = shape
+    children = [_compile(child, counter) for child in children]
+
+    if connector == AND:
+        def match_node(entity, values):
+            for child in children:
+                if not child(entity, values):
+                    return negated
+            return not negated
+    else:
+        def match_node(entity, values):
+            for child in children:
+                if child(entity, values):
+                    return not negated
+            return negated
+    return match_node
+
+
+def _compile_leaf(index, column, lookup_type, is_key, none_match):
+    if lookup_type == 'ancestor':
+        def match_ancestor(entity, values):
+            ancestor = values[index]
+            key = entity.key()
+            while key is not None:
+                if key == ancestor:
+                    return True
+                key = key.parent()
+            return False
+        return match_ancestor
+
+    operator = EMULATED_OPS[lookup_type]
+
+    def match_leaf(entity, values):
+        if is_key:
+            value = entity.key()
+        else:
+            value = entity.get(column)
+        if value is None and none_match is not None:
+            return none_match
+        return operator(value, values[index])
+    return match_leaf
@@ -1,3 +1,5 @@
+from __future__ import with_statement
+
 from google.appengine.datastore.datastore_query import Cursor
 from django.db import models, DEFAULT_DB_ALIAS
 
@@ -13,9 +15,20 @@ class CursorQueryMixin(object):
         kwargs['_gae_cursor'] = getattr(self, '_gae_cursor', None)
         kwargs['_gae_start_cursor'] = getattr(self, '_gae_start_cursor', None)
         kwargs['_gae_end_cursor'] = getattr(self, '_gae_end_cursor', None)
+        kwargs['_gae_config'] = dict(getattr(self, '_gae_config', {}))
         return super(CursorQueryMixin, self).clone(*args, **kwargs)
 
 
+def _gae_queryset(queryset):
+    queryset = queryset.all()
+
+    if CursorQueryMixin not in queryset.query.__class__.__bases__:
+        class CursorQuery(CursorQueryMixin, queryset.query.__class__):
+            pass
+        queryset.query = queryset.query.clone(klass=CursorQuery)
+    return queryset
+
+
 def get_cursor(queryset):
     # Evaluate QuerySet.
     len(queryset)
@@ -24,12 +37,7 @@ def get_cursor(queryset):
 
 
 def set_cursor(queryset, start=None, end=None):
-    queryset = queryset.all()
-
-    if CursorQueryMixin not in queryset.query.__class__.__bases__:
-        class CursorQuery(CursorQueryMixin, queryset.query.__class__):
-            pass
-        queryset.query = queryset.query.clone(klass=CursorQuery)
+    queryset = _gae_queryset(queryset)
 
     if start is not None:
         start = Cursor.from_websafe_string(start)
@@ -40,6 +48,134 @@ def set_cursor(queryset, start=None, end=None):
     return queryset
 
 
+def set_batch_options(queryset, batch_size=None, prefetch_size=None,
+                      background_fetch=None):
+    """
+    Sets the number of results fetched by each datastore RPC while
+    iterating over the queryset (prefetch_size applies to the first
+    one) and whether the following batch should be requested while the
+    current one is being processed. Options left as None use the
+    database's BATCH_SIZE, PREFETCH_SIZE and BACKGROUND_FETCH settings.
+    """
+    queryset = _gae_queryset(queryset)
+    config = queryset.query._gae_config
+    for name, value in (('batch_size', batch_size),
+                        ('prefetch_size', prefetch_size),
+                        ('background_fetch', background_fetch)):
+        if value is not None:
+            config[name] = value
+    return queryset
+
+
+def set_count_shards(queryset, shards):
+    """
+    Makes count() split the query into the given number of key ranges
+    counted in parallel (overriding the COUNT_SHARDS database option).
+    Only used for unlimited counts of queries without inequality
+    filters or ordering.
+    """
+    queryset = _gae_queryset(queryset)
+    queryset.query._gae_config['count_shards'] = shards
+    return queryset
+
+
+def delete_entities(queryset, limit=None):
+    """
+    Deletes entities matching the queryset directly on the datastore,
+    streaming keys from keys-only queries to batch deletes, without
+    loading model instances, sending signals or collecting related
+    objects (unlike QuerySet.delete()).
+
+    If a limit is given, at most that many entities are deleted and a
+    cursor is returned that can be passed to set_cursor() to continue
+    (e.g. from a follow-up task); None is returned once there's nothing
+    left to delete.
+    """
+    from django.db.models.sql import DeleteQuery
+
+    queryset = _gae_queryset(queryset)
+    if limit is not None:
+        queryset.query._gae_config['delete_limit'] = limit
+    query = queryset.query.clone(klass=DeleteQuery)
+    query.get_compiler(queryset.db).execute_sql()
+
+    cursor = getattr(query, '_gae_cursor', None)
+    if cursor is None:
+        return None
+    return Cursor.to_websafe_string(cursor)
+
+
+class AncestorPrefetchMixin(object):
+
+    def iterator(self):
+        from ..fields import resolve_ancestors
+
+        instances = list(super(AncestorPrefetchMixin, self).iterator())
+        resolve_ancestors(instances)
+        return iter(instances)
+
+
+def prefetch_ancestors(queryset):
+    """
+    Makes the queryset load parents of all of its results (instances
+    with AncestorKey primary keys) at once when it's evaluated, using
+    batched Gets, rather than one get() for each row whose parent is
+    accessed.
+    """
+    if isinstance(queryset, AncestorPrefetchMixin):
+        return queryset.all()
+
+    class AncestorPrefetchQuerySet(AncestorPrefetchMixin,
+                                   queryset.__class__):
+        pass
+    return queryset._clone(klass=AncestorPrefetchQuerySet)
+
+
+def update_entities(queryset, values, transactional=True, retries=None):
+    """
+    Updates entities matching the queryset with the given values (a
+    dict, as passed to QuerySet.update as keyword arguments), returning
+    a dict with numbers of entities updated, skipped (because they no
+    longer matched the queryset's filters or were deleted) and of
+    retried transactions.
+
+    If transactional is False entities are read and written back in
+    batches without transactions, so concurrent changes to them may be
+    lost (last write wins); otherwise each entity group is updated in
+    its own transaction, retried up to the given number of times.
+    """
+    from django.db.models.sql import UpdateQuery
+
+    queryset = _gae_queryset(queryset)
+    config = queryset.query._gae_config
+    config['update_transactional'] = transactional
+    if retries is not None:
+        config['update_retries'] = retries
+    query = queryset.query.clone(klass=UpdateQuery)
+    query.add_update_values(values)
+    query.get_compiler(queryset.db).execute_sql(None)
+    return query._gae_update_stats
+
+
+def allocate_ids(model, count, ancestor=None):
+    """
+    Reserves ids for count new instances of the model, returning values
+    that can be used as their primary keys (AncestorKeys if an ancestor
+    instance is given), so that they (and foreign keys pointing to
+    them) are known before the instances are saved.
+    """
+    from .batch import allocate_keys
+    from ..fields import AncestorKey
+
+    parent = None
+    if ancestor is not None:
+        parent = AncestorKey(ancestor=ancestor).parent()
+    keys = allocate_keys(model._meta.db_table, count, parent)
+    if ancestor is None:
+        return [key.id() for key in keys]
+    return [AncestorKey(ancestor=ancestor, key_id=key.id()) for key in keys]
+
+
 def commit_locked(func_or_using=None, retries=None, xg=False):
     """
     Decorator that locks rows on DB reads.
@@ -59,8 +195,15 @@ def commit_locked(func_or_using=None, retries=None, xg=False):
             if xg:
                 option_dict['xg'] = True
 
+            from .cache import invalidate_after_commit
+            from .writes import flush
+
+            # Buffered writes can't be put in the transaction.
+            flush()
+
             options = TransactionOptions(**option_dict)
-            return RunInTransactionOptions(options, func, *args, **kw)
+            with invalidate_after_commit():
+                return RunInTransactionOptions(options, func, *args, **kw)
 
         return wraps(func)(_commit_locked)
 
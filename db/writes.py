@@ -0,0 +1,222 @@
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+import logging
+import sys
+import threading
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.utils import DatabaseError
+
+from google.appengine.api.datastore import Entity, IsInTransaction, \
+    PutAsync
+
+from . import cache, context
+from .batch import allocate_keys, chunked, DEFAULT_MAX_CONCURRENT_RPCS, \
+    DEFAULT_PUT_CHUNK_SIZE
+
+
+# Number of ids allocated at once for new entities of a kind (and
+# parent) while writes are buffered.
+ID_BATCH_SIZE = 50
+
+_local = threading.local()
+
+
+class WriteBuffer(object):
+    """
+    Keeps entities saved while write-behind is active by their keys,
+    putting them in batches when flushed.
+
+    New entities get keys with ids allocated in advance, so their
+    primary keys are known right away. Errors of batch Puts are kept
+    until raise_errors is called.
+    """
+
+    def __init__(self, chunk_size=DEFAULT_PUT_CHUNK_SIZE,
+                 max_concurrent_rpcs=DEFAULT_MAX_CONCURRENT_RPCS):
+        self.chunk_size = chunk_size
+        self.max_concurrent_rpcs = max_concurrent_rpcs
+        self.entities = OrderedDict()
+        self.cached_keys = set()
+        self.errors = []
+        self._keys = {}
+
+    def _allocate_key(self, kind, parent):
+        keys = self._keys.get((kind, parent))
+        if not keys:
+            keys = self._keys[(kind, parent)] = deque(
+                allocate_keys(kind, ID_BATCH_SIZE, parent))
+        return keys.popleft()
+
+    def put(self, entities, cached=False):
+        """
+        Buffers entities, returning their keys. Keys of entities of
+        models using the entity cache should be marked as cached, so
+        they are invalidated when flushed.
+        """
+        keys = []
+        for entity in entities:
+            key = entity.key()
+            if not key.has_id_or_name():
+                key = self._allocate_key(entity.kind(), entity.parent())
+                complete = Entity(
+                    entity.kind(), parent=key.parent(), id=key.id(),
+                    unindexed_properties=entity.unindexed_properties())
+                complete.update(entity)
+                entity = complete
+            self.entities.pop(key, None)
+            self.entities[key] = entity
+            if cached:
+                self.cached_keys.add(key)
+            keys.append(key)
+        return keys
+
+    def get_multi(self, keys):
+        """
+        Returns a dict with copies of buffered entities for any of the
+        given keys (so changes made to them aren't put when flushing).
+        """
+        return dict((key, _copy_entity(self.entities[key])) for key in keys
+                    if key in self.entities)
+
+    def discard(self, keys):
+        """
+        Drops buffered entities with any of the given keys (e.g. ones
+        replaced by writes made in a transaction).
+        """
+        for key in keys:
+            self.entities.pop(key, None)
+            self.cached_keys.discard(key)
+
+    def flush(self):
+        """
+        Puts all buffered entities using concurrent batch Puts.
+        """
+        entities = self.entities.values()
+        cached_keys = list(self.cached_keys)
+        self.entities = OrderedDict()
+        self.cached_keys = set()
+        if not entities:
+            return
+
+        if cached_keys:
+            cache.lock(cached_keys)
+        rpcs = deque()
+        for chunk in chunked(entities, self.chunk_size):
+            if len(rpcs) >= self.max_concurrent_rpcs:
+                self._finish(rpcs.popleft())
+            rpcs.append(PutAsync(chunk))
+        while rpcs:
+            self._finish(rpcs.popleft())
+        if cached_keys:
+            cache.invalidate(cached_keys)
+        context.evict([entity.key() for entity in entities])
+
+    def _finish(self, rpc):
+        try:
+            rpc.get_result()
+        except Exception:
+            self.errors.append(sys.exc_info())
+
+    def raise_errors(self):
+        if self.errors:
+            exc_type, exc_value, traceback = self.errors[0]
+            self.errors = []
+            raise exc_type, exc_value, traceback
+
+
+def _copy_entity(entity):
+    key = entity.key()
+    copy = Entity(key.kind(), parent=key.parent(), _app=key.app(),
+                  id=key.id(), name=key.name(), namespace=key.namespace(),
+                  unindexed_properties=entity.unindexed_properties())
+    copy.update(entity)
+    return copy
+
+
+def activate(using=DEFAULT_DB_ALIAS):
+    """
+    Starts buffering writes of the current thread (see write_behind).
+    Put RPCs are split according to the PUT_CHUNK_SIZE and
+    MAX_CONCURRENT_RPCS options of the given database.
+    """
+    settings_dict = connections[using].settings_dict
+    _local.buffer = WriteBuffer(
+        settings_dict.get('PUT_CHUNK_SIZE', DEFAULT_PUT_CHUNK_SIZE),
+        settings_dict.get('MAX_CONCURRENT_RPCS',
+                          DEFAULT_MAX_CONCURRENT_RPCS))
+
+
+def deactivate():
+    """
+    Stops buffering writes, putting buffered entities and raising the
+    first error met while doing so.
+    """
+    buffer = get_write_buffer()
+    if buffer is None:
+        return
+    _local.buffer = None
+    buffer.flush()
+    buffer.raise_errors()
+
+
+def get_write_buffer():
+    """
+    Returns the current thread's WriteBuffer or None if writes are not
+    buffered.
+    """
+    return getattr(_local, 'buffer', None)
+
+
+def get_buffered(keys):
+    buffer = get_write_buffer()
+    if buffer is None:
+        return {}
+    return buffer.get_multi(keys)
+
+
+def flush():
+    """
+    Puts entities buffered so far (e.g. before a query-based update
+    or delete), keeping any errors for when buffering ends.
+
+    Buffered entities can't be put inside a transaction (they would
+    become part of it), so they have to be flushed before it starts
+    (commit_locked does so).
+    """
+    buffer = get_write_buffer()
+    if buffer is None or not buffer.entities:
+        return
+    if IsInTransaction():
+        raise DatabaseError("Buffered writes can't be put inside a "
+                            "transaction, flush them before it starts.")
+    buffer.flush()
+
+
+@contextmanager
+def write_behind(using=DEFAULT_DB_ALIAS):
+    """
+    Buffers entities saved in the block, putting them using a few
+    batch Puts when it exits, and raising any error at that point.
+
+    Primary key lookups see buffered entities, but other queries
+    don't (until the block ends). Writes made in transactions are not
+    buffered (and replace buffered entities with the same keys);
+    transactions started by commit_locked put buffered entities first.
+    Nested blocks are merged into the outermost one.
+    """
+    if get_write_buffer() is not None:
+        yield
+        return
+
+    activate(using)
+    try:
+        yield
+    except:
+        exc_info = sys.exc_info()
+        try:
+            deactivate()
+        except Exception:
+            logging.exception("Putting buffered entities failed.")
+        raise exc_info[0], exc_info[1], exc_info[2]
+    deactivate()
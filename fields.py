@@ -1,9 +1,12 @@
-from django.db.models import AutoField
+from django.db.models import AutoField, IntegerField
+from django.utils.functional import curry
 
 from google.appengine.api.datastore import Key
 from google.appengine.ext import db
 from django.db.models.sql.where import Constraint
 
+from .db import counters
+
 class AncestorNode(Constraint):
     def __init__(self, instance):
         self.instance = instance
@@ -29,11 +32,7 @@ class PossibleDescendent(object):
     def parent(self):
         if not isinstance(self.pk, AncestorKey):
             return None
-        ak = self.pk
-
-        if ak._parent_cache is None:
-            ak._parent_cache = ak._parent_model.objects.get(pk=ak._parent_key.id_or_name())
-        return ak._parent_cache
+        return self.pk.ancestor()
 
 
 class AncestorKey(object):
@@ -57,6 +56,17 @@ class AncestorKey(object):
     def parent(self):
         return self._parent_key
 
+    def ancestor(self):
+        """
+        Returns the parent instance, only loading it the first time it's
+        needed (unless it was given or prefetched, see
+        resolve_ancestors).
+        """
+        if self._parent_cache is None:
+            self._parent_cache = self._parent_model.objects.get(
+                pk=self._parent_key.id_or_name())
+        return self._parent_cache
+
     def id(self):
         return self.key_id
 
@@ -64,6 +74,26 @@ class AncestorKey(object):
         return None
 
 
+def resolve_ancestors(instances):
+    """
+    Loads parents of instances with AncestorKey primary keys that
+    weren't loaded yet, getting all distinct parents of a model with a
+    single primary key lookup (batched Gets).
+    """
+    keys_by_model = {}
+    for instance in instances:
+        key = instance.pk
+        if isinstance(key, AncestorKey) and key._parent_cache is None:
+            keys_by_model.setdefault(key._parent_model, []).append(key)
+
+    for model, keys in keys_by_model.items():
+        parent_ids = set(key._parent_key.id_or_name() for key in keys)
+        parents = dict((parent.pk, parent) for parent in
+                       model.objects.filter(pk__in=parent_ids))
+        for key in keys:
+            key._parent_cache = parents.get(key._parent_key.id_or_name())
+
+
 class GAEKeyField(AutoField):
     #Make sure to_python is called on assignments
     def __init__(self, ancestor_model, *args, **kwargs):
@@ -75,9 +105,11 @@ class GAEKeyField(AutoField):
         super(GAEKeyField, self).__init__(*args, **kwargs)
 
     def to_python(self, value):
+        # The parent is only loaded when it's accessed.
         if isinstance(value, Key):
             return AncestorKey(
-                ancestor=self.ancestor_model.objects.get(pk=value.parent().id_or_name()),
+                ancestor_model=self.ancestor_model,
+                ancestor_pk=value.parent().id_or_name(),
                 key_id=value.id_or_name()
             )
         return value
@@ -93,3 +125,50 @@ class GAEKeyField(AutoField):
                 parent=value._parent_key
             )
         return super(GAEKeyField, self).get_db_prep_value(value, connection)
+
+
+def entity_key(instance):
+    """
+    Returns the datastore key of a saved model instance.
+    """
+    pk = instance.pk
+    if isinstance(pk, AncestorKey):
+        return Key.from_path(instance._meta.db_table, pk.key_id,
+                             parent=pk._parent_key)
+    return Key.from_path(instance._meta.db_table, pk)
+
+
+class ShardedCounterField(IntegerField):
+    """
+    A count that can be incremented often by concurrent requests,
+    using sharded counters (see db.counters).
+
+    The stored value is only the counter's base (e.g. an imported
+    count); increments made using QuerySet.update(field=F(field) + n)
+    or instance.increment_FOO(n) are added to shards instead, and
+    instance.get_FOO_count() returns the base with the (cached) total
+    of the shards. Increments made in transactions update the stored
+    value as usual.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.shards = kwargs.pop('shards', counters.DEFAULT_SHARDS)
+        kwargs.setdefault('default', 0)
+        super(ShardedCounterField, self).__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name):
+        super(ShardedCounterField, self).contribute_to_class(cls, name)
+        setattr(cls, 'get_%s_count' % self.name,
+                curry(_get_counter_count, field=self))
+        setattr(cls, 'increment_%s' % self.name,
+                curry(_increment_counter, field=self))
+
+
+def _get_counter_count(instance, field):
+    return (getattr(instance, field.attname) or 0) + counters.get_count(
+        entity_key(instance), field.column, field.shards)
+
+
+def _increment_counter(instance, delta=1, field=None):
+    counters.increment(entity_key(instance), field.column, delta,
+                       field.shards)
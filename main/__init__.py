@@ -61,9 +61,34 @@ class DjangoAppEngineMiddleware:
                 appstats_wsgi_middleware
             app = appstats_wsgi_middleware(app)
 
+        # Record datastore RPCs of each request, logging a summary
+        # and / or adding it to responses as a header.
+        self.datastore_stats = getattr(settings, 'DATASTORE_STATS', False)
+        self.datastore_stats_header = getattr(
+            settings, 'DATASTORE_STATS_HEADER', None)
+
         self.wrapped_app = app
 
     def __call__(self, environ, start_response):
         #Always make sure the settings module is set - AppEngine sometimes loses it!
         os.environ['DJANGO_SETTINGS_MODULE'] = self.settings_module
-        return self.wrapped_app(environ, start_response)
+        if not self.datastore_stats and not self.datastore_stats_header:
+            return self.wrapped_app(environ, start_response)
+
+        from djangoappengine.db import instrumentation
+        instrumentation.activate()
+
+        def stats_start_response(status, headers, exc_info=None):
+            stats = instrumentation.get_request_stats()
+            if self.datastore_stats_header and stats is not None:
+                headers = list(headers)
+                headers.append((self.datastore_stats_header, stats.format()))
+            return start_response(status, headers, exc_info)
+
+        try:
+            return self.wrapped_app(environ, stats_start_response)
+        finally:
+            stats = instrumentation.deactivate()
+            if self.datastore_stats:
+                logging.info("Datastore usage of %s: %s" % (
+                    environ.get('PATH_INFO'), stats.format()))
@@ -0,0 +1,37 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', action='store', dest='sizes',
+            default='1000,10000',
+            help='Comma-separated numbers of rows to benchmark with.'),
+        make_option('--database', action='store', dest='database',
+            default='default', help='Database to benchmark.'),
+        make_option('--benchmarks', action='store', dest='benchmarks',
+            default='decoding,queries',
+            help='Comma-separated names of benchmarks to run.'),
+        make_option('--repeat', action='store', dest='repeat',
+            default='3',
+            help='Number of runs of each query (the best one is kept).'),
+    )
+    help = 'Runs backend benchmarks, printing results as JSON lines.'
+
+    requires_model_validation = False
+
+    def handle(self, *args, **options):
+        from ...benchmarks import decoding, queries
+
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        benchmarks = options['benchmarks'].split(',')
+        results = []
+        if 'decoding' in benchmarks:
+            results.extend(decoding.run(sizes, options['database']))
+        if 'queries' in benchmarks:
+            results.extend(queries.run(sizes, options['database'],
+                                       int(options['repeat'])))
+        for result in results:
+            self.stdout.write(json.dumps(result, sort_keys=True) + '\n')
@@ -0,0 +1,50 @@
+import logging
+
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from .db import context, writes
+
+
+class ContextCacheMiddleware(object):
+    """
+    Caches entities fetched from the datastore while handling a request,
+    so loading the same entity again (e.g. a ForeignKey target shared
+    by many rows) doesn't need another Get. The cache is dropped at the
+    end of the request.
+
+    The number of cached entities is limited by the CONTEXT_CACHE_SIZE
+    option of the default database.
+    """
+
+    def process_request(self, request):
+        settings_dict = connections[DEFAULT_DB_ALIAS].settings_dict
+        context.activate(settings_dict.get(
+            'CONTEXT_CACHE_SIZE', context.DEFAULT_CONTEXT_CACHE_SIZE))
+
+    def process_response(self, request, response):
+        context.deactivate()
+        return response
+
+    def process_exception(self, request, exception):
+        context.deactivate()
+
+
+class WriteBehindMiddleware(object):
+    """
+    Buffers entities saved while handling a request, putting them using
+    a few concurrent batch Puts after the view returns (see
+    djangoappengine.db.writes.write_behind).
+    """
+
+    def process_request(self, request):
+        writes.activate()
+
+    def process_response(self, request, response):
+        writes.deactivate()
+        return response
+
+    def process_exception(self, request, exception):
+        try:
+            writes.deactivate()
+        except Exception:
+            logging.exception("Putting buffered entities failed.")
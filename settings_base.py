@@ -30,6 +30,81 @@ DATABASES = {
         # changing! Defaults to False if not set.
         # 'STORE_RELATIONS_AS_DB_KEYS': True,
 
+        # Run the sub-queries of __in and negated exact lookups
+        # concurrently (starting no more than MAX_CONCURRENT_RPCS at a
+        # time) and merge their results as they arrive, instead of
+        # using the SDK's MultiQuery. Defaults to True if not set.
+        # 'CONCURRENT_MULTIQUERY': False,
+
+        # Refuse __in lookups producing more sub-queries than this (by
+        # default there is no limit).
+        # 'MAX_IN_COMBINATIONS': 300,
+
+        # Run sub-queries of __in lookups on related fields (such as
+        # the ones done by prefetch_related) as keys-only queries and
+        # get the matching entities by key, so cached ones don't have
+        # to be fetched again. Defaults to True if not set.
+        # 'KEYS_ONLY_FANOUT': False,
+
+        # Default number of results fetched by each query RPC (the
+        # first batch uses PREFETCH_SIZE), and whether the next batch
+        # should be fetched while the current one is being processed.
+        # Can be overridden for a queryset using
+        # djangoappengine.db.utils.set_batch_options. Uses the SDK
+        # defaults if not set.
+        # 'BATCH_SIZE': 500,
+        # 'PREFETCH_SIZE': 50,
+        # 'BACKGROUND_FETCH': True,
+
+        # Primary key lookups are split into Get RPCs of GET_CHUNK_SIZE
+        # keys (100 by default) and deletes into Delete RPCs of
+        # DELETE_CHUNK_SIZE keys (500 by default); batch RPCs are run
+        # with no more than MAX_CONCURRENT_RPCS (10 by default) in
+        # flight at a time.
+        # 'GET_CHUNK_SIZE': 100,
+        # 'DELETE_CHUNK_SIZE': 500,
+        # 'MAX_CONCURRENT_RPCS': 10,
+
+        # Fetch only the selected fields (for values(), values_list()
+        # or only()) using projection queries when all of them are
+        # indexed. Projecting several properties (or filtering or
+        # ordering on other ones) needs composite indexes, and entities
+        # with no value for a projected property are skipped. Defaults
+        # to False if not set.
+        # 'PROJECTION_QUERIES': True,
+
+        # Reuse sub-query filters built for queries with the same
+        # shape (see djangoappengine.db.plans), only binding new lookup
+        # values. Defaults to True if not set.
+        # 'QUERY_PLAN_CACHE': False,
+
+        # Cache entities fetched by primary key in memcache (models can
+        # also be opted in or out using an ENTITY_CACHE dict in one of
+        # the GAE_SETTINGS_MODULES). Defaults to False if not set.
+        # 'ENTITY_CACHE': True,
+
+        # Maximum number of entities kept for a request by
+        # djangoappengine.middleware.ContextCacheMiddleware (1000 by
+        # default).
+        # 'CONTEXT_CACHE_SIZE': 1000,
+
+        # Split unlimited counts into this many key ranges counted in
+        # parallel (may require composite indexes including __key__).
+        # Can be overridden for a queryset using
+        # djangoappengine.db.utils.set_count_shards.
+        # 'COUNT_SHARDS': 4,
+
+        # Bulk inserts (QuerySet.bulk_create or
+        # djangoappengine.utils.bulk_create) and entities buffered by
+        # djangoappengine.db.writes.write_behind are put using RPCs of
+        # PUT_CHUNK_SIZE entities (500 by default).
+        # 'PUT_CHUNK_SIZE': 500,
+
+        # Log query operations taking longer than this (in seconds),
+        # along with their filters (see djangoappengine.db.
+        # instrumentation). Not set by default.
+        # 'SLOW_QUERY_THRESHOLD': 1.0,
+
         'DEV_APPSERVER_OPTIONS': {
             # Optional parameters for development environment.
 
@@ -0,0 +1,93 @@
+"""
+Test helpers for checking how many datastore RPCs code makes (Django's
+assertNumQueries doesn't see them).
+"""
+import sys
+
+from .db import instrumentation
+
+
+class DatastoreCallCounter(object):
+    """
+    Counts datastore_v3 RPCs (by method, e.g. 'Get', 'Put', 'Delete',
+    'RunQuery', 'Next', 'BeginTransaction' or 'Commit') made while
+    used as a context manager, using RPC hooks installed on the
+    current API proxy (such as the testbed stubs set up by
+    db.stubs.StubManager).
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    def __enter__(self):
+        instrumentation.install_hooks()
+        instrumentation.rpc_completed.connect(self._count, weak=False)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        instrumentation.rpc_completed.disconnect(self._count)
+
+    def _count(self, sender, call, **kwargs):
+        self.calls[call] = self.calls.get(call, 0) + 1
+
+    @property
+    def total(self):
+        return sum(self.calls.itervalues())
+
+
+class _AssertNumDatastoreCallsContext(object):
+
+    def __init__(self, test_case, expected):
+        self.test_case = test_case
+        self.expected = expected
+        self.counter = DatastoreCallCounter()
+
+    def __enter__(self):
+        return self.counter.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.counter.__exit__(exc_type, exc_value, traceback)
+        if exc_type is None:
+            self.test_case.assertDatastoreCalls(self.expected,
+                                                self.counter.calls)
+
+
+class DatastoreCallsMixin(object):
+    """
+    Adds assertNumDatastoreCalls to a TestCase.
+    """
+
+    def assertDatastoreCalls(self, expected, calls):
+        """
+        Checks the total number of RPCs if expected is a number, or
+        the number of RPCs of each method given if it is a dict
+        (methods not included aren't checked).
+        """
+        if isinstance(expected, dict):
+            actual = dict((method, calls.get(method, 0))
+                          for method in expected)
+        else:
+            actual = sum(calls.itervalues())
+        self.assertEqual(actual, expected,
+                         "%r datastore calls expected, %r made." % (
+                             expected, calls))
+
+    def assertNumDatastoreCalls(self, expected, func=None, *args,
+                                **kwargs):
+        """
+        Asserts that calling func with the given arguments makes the
+        expected datastore RPCs (see assertDatastoreCalls). Returns a
+        context manager checking the RPCs made in its block if func
+        is not given.
+        """
+        context = _AssertNumDatastoreCallsContext(self, expected)
+        if func is None:
+            return context
+
+        context.__enter__()
+        try:
+            func(*args, **kwargs)
+        except:
+            context.__exit__(*sys.exc_info())
+            raise
+        context.__exit__(None, None, None)
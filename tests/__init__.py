@@ -7,3 +7,8 @@ from .not_return_sets import NonReturnSetsTest
 from .order import OrderTest
 from .transactions import TransactionTest
 from .ancestor import AncestorQueryTest
+from .cache import EntityCacheTest, ContextCacheTest
+from .writes import WriteBehindTest, BulkCreateTest
+from .instrumentation import InstrumentationTest
+from .rpcs import DatastoreCallsTest
+from .counters import ShardedCounterTest
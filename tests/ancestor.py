@@ -3,6 +3,7 @@
 from django.test import TestCase
 from django.db import models
 
+from djangoappengine.db.utils import prefetch_ancestors
 from djangoappengine.fields import GAEKeyField, AncestorKey, PossibleDescendent
 
 class AncestorModel(models.Model):
@@ -71,3 +72,26 @@ class AncestorQueryTest(TestCase):
 
         child_count = ChildModel.descendents_of(parent).filter(field1="apples").count()
         self.assertEqual(2, child_count)
+
+    def test_prefetch_ancestors(self):
+        parents = [AncestorModel.objects.create() for _ in range(2)]
+        for parent in parents:
+            for _ in range(2):
+                ChildModel.objects.create(id=AncestorKey(parent))
+        ChildModel.objects.create()
+
+        # Parents are only loaded when they're accessed.
+        children = list(ChildModel.objects.all())
+        self.assertTrue(all(child.pk._parent_cache is None
+                            for child in children
+                            if isinstance(child.pk, AncestorKey)))
+
+        children = list(prefetch_ancestors(ChildModel.objects.all()))
+        self.assertEqual(len(children), 5)
+        for child in children:
+            if isinstance(child.pk, AncestorKey):
+                self.assertTrue(child.pk._parent_cache in parents)
+                self.assertEqual(child.parent().pk,
+                                 child.pk.parent().id_or_name())
+            else:
+                self.assertEqual(child.parent(), None)
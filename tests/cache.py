@@ -0,0 +1,137 @@
+from django.test import TestCase
+
+from google.appengine.api import memcache
+from google.appengine.api.datastore import Get, Key, Put
+
+from ..db import context
+from ..db.cache import LOCKED, cache_key
+from ..db.db_settings import get_entity_cache
+from ..db.utils import commit_locked, update_entities
+from .testmodels import EmailModel
+
+
+class EntityCacheTest(TestCase):
+
+    def setUp(self):
+        get_entity_cache()[EmailModel] = True
+        self.instance = EmailModel.objects.create(
+            email='app-engine@scholardocs.com', number=1)
+        self.key = Key.from_path(EmailModel._meta.db_table,
+                                 self.instance.pk)
+
+    def tearDown(self):
+        del get_entity_cache()[EmailModel]
+        memcache.flush_all()
+
+    def _change_in_datastore(self, number):
+        entity = Get(self.key)
+        entity['number'] = number
+        Put(entity)
+
+    def test_get_caches_entities(self):
+        self.assertEqual(EmailModel.objects.get(pk=self.instance.pk).number, 1)
+        self.assertNotIn(memcache.get(cache_key(self.key)), (None, LOCKED))
+
+        # Changes not made through the backend aren't seen.
+        self._change_in_datastore(2)
+        self.assertEqual(EmailModel.objects.get(pk=self.instance.pk).number, 1)
+        self.assertEqual(
+            [instance.number for instance in EmailModel.objects.filter(
+                pk__in=[self.instance.pk, self.instance.pk + 1])],
+            [1])
+
+    def test_update_invalidates(self):
+        EmailModel.objects.get(pk=self.instance.pk)
+        EmailModel.objects.filter(pk=self.instance.pk).update(number=3)
+        self.assertEqual(memcache.get(cache_key(self.key)), None)
+        self.assertEqual(EmailModel.objects.get(pk=self.instance.pk).number, 3)
+
+        self.instance.number = 4
+        self.instance.save()
+        self.assertEqual(EmailModel.objects.get(pk=self.instance.pk).number, 4)
+
+    def test_delete_invalidates(self):
+        EmailModel.objects.get(pk=self.instance.pk)
+        self.instance.delete()
+        self.assertEqual(memcache.get(cache_key(self.key)), None)
+        self.assertRaises(EmailModel.DoesNotExist, EmailModel.objects.get,
+                          pk=self.instance.pk)
+
+    def test_transactions_bypass_cache(self):
+        EmailModel.objects.get(pk=self.instance.pk)
+        self._change_in_datastore(5)
+
+        @commit_locked
+        def get_number():
+            return EmailModel.objects.get(pk=self.instance.pk).number
+
+        self.assertEqual(get_number(), 5)
+
+
+class ContextCacheTest(TestCase):
+
+    def setUp(self):
+        context.activate()
+        self.instances = [EmailModel.objects.create(email=email)
+                          for email in ('app-engine@scholardocs.com',
+                                        'sharingan@uchias.com',
+                                        'rinnengan@sage.de')]
+
+    def tearDown(self):
+        context.deactivate()
+
+    def _change_in_datastore(self, instance, email):
+        entity = Get(Key.from_path(EmailModel._meta.db_table, instance.pk))
+        entity['email'] = email
+        Put(entity)
+
+    def test_repeated_gets(self):
+        instance = self.instances[0]
+        EmailModel.objects.get(pk=instance.pk)
+        self._change_in_datastore(instance, 'rasengan@naruto.com')
+        self.assertEqual(EmailModel.objects.get(pk=instance.pk).email,
+                         'app-engine@scholardocs.com')
+
+        context.deactivate()
+        self.assertEqual(EmailModel.objects.get(pk=instance.pk).email,
+                         'rasengan@naruto.com')
+
+    def test_queries_fill_cache(self):
+        list(EmailModel.objects.all())
+        for instance in self.instances:
+            self._change_in_datastore(instance, 'rasengan@naruto.com')
+        self.assertEqual(
+            [instance.email for instance in EmailModel.objects.filter(
+                pk__in=[instance.pk for instance in self.instances])],
+            ['app-engine@scholardocs.com', 'sharingan@uchias.com',
+             'rinnengan@sage.de'])
+
+    def test_writes_evict(self):
+        instance = EmailModel.objects.get(pk=self.instances[0].pk)
+        instance.email = 'rasengan@naruto.com'
+        instance.save()
+        self.assertEqual(EmailModel.objects.get(pk=instance.pk).email,
+                         'rasengan@naruto.com')
+
+        instance.delete()
+        self.assertRaises(EmailModel.DoesNotExist, EmailModel.objects.get,
+                          pk=instance.pk)
+
+    def test_cached_entities_unchanged(self):
+        list(EmailModel.objects.all())
+        update_entities(EmailModel.objects.filter(pk=self.instances[1].pk),
+                        {'number': 2}, transactional=False)
+        entity = Get(Key.from_path(EmailModel._meta.db_table,
+                                   self.instances[1].pk))
+        self.assertNotIn(EmailModel._meta.pk.column, entity)
+
+    def test_size_limit(self):
+        context.activate(max_size=2)
+        for instance in self.instances:
+            EmailModel.objects.get(pk=instance.pk)
+        self.assertEqual(len(context.get_context_cache().entities), 2)
+
+        instance = self.instances[0]
+        self._change_in_datastore(instance, 'rasengan@naruto.com')
+        self.assertEqual(EmailModel.objects.get(pk=instance.pk).email,
+                         'rasengan@naruto.com')
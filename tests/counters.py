@@ -0,0 +1,75 @@
+from django.db import models
+from django.db.models import F
+from django.test import TestCase
+
+from google.appengine.api import memcache
+
+from ..db import counters
+from ..db.utils import commit_locked, update_entities
+from ..fields import ShardedCounterField, entity_key
+
+
+class CounterModel(models.Model):
+    name = models.CharField(max_length=10)
+    hits = ShardedCounterField(shards=4)
+
+
+class ShardedCounterTest(TestCase):
+
+    def setUp(self):
+        self.instance = CounterModel.objects.create(name='page')
+        self.counter = counters.counter_name(entity_key(self.instance),
+                                             'hits')
+
+    def tearDown(self):
+        memcache.flush_all()
+
+    def _increment(self, delta):
+        return CounterModel.objects.filter(pk=self.instance.pk).update(
+            hits=F('hits') + delta)
+
+    def test_update_increments(self):
+        self.assertEqual(self._increment(2), 1)
+        self.assertEqual(self._increment(3), 1)
+        self.assertEqual(self.instance.get_hits_count(), 5)
+
+        # The stored value is left alone.
+        self.assertEqual(CounterModel.objects.get().hits, 0)
+
+        flush_key = '%sflush:%s' % (counters.KEY_PREFIX, self.counter)
+        self.assertNotEqual(memcache.get(flush_key), None)
+        counters.flush(self.counter, 4)
+        memcache.delete('%stotal:%s' % (counters.KEY_PREFIX, self.counter))
+        self.assertEqual(self.instance.get_hits_count(), 5)
+
+        # Increments made after a flush started schedule another one.
+        self.assertEqual(memcache.get(flush_key), None)
+        self._increment(1)
+        self.assertNotEqual(memcache.get(flush_key), None)
+        self.assertEqual(self.instance.get_hits_count(), 6)
+
+    def test_update_entities(self):
+        self.assertEqual(
+            update_entities(CounterModel.objects.all(),
+                            {'hits': F('hits') + 1}),
+            {'updated': 1, 'skipped': 0, 'retried': 0})
+        self.assertEqual(self.instance.get_hits_count(), 1)
+
+    def test_decrements(self):
+        self.instance.increment_hits(4)
+        self.instance.increment_hits(-1)
+        CounterModel.objects.filter(name='page').update(hits=F('hits') - 1)
+        self.assertEqual(self.instance.get_hits_count(), 2)
+
+    def test_other_values(self):
+        CounterModel.objects.filter(pk=self.instance.pk).update(
+            hits=F('hits') + 1, name='home')
+        instance = CounterModel.objects.get()
+        self.assertEqual((instance.name, instance.hits), ('home', 0))
+        self.assertEqual(instance.get_hits_count(), 1)
+
+    def test_transactions_update_base(self):
+        commit_locked(self._increment)(2)
+        instance = CounterModel.objects.get()
+        self.assertEqual(instance.hits, 2)
+        self.assertEqual(instance.get_hits_count(), 2)
@@ -8,7 +8,9 @@ from google.appengine.api.datastore_types import Text, Category, Email, \
     Link, PhoneNumber, PostalAddress, Text, Blob, ByteString, GeoPt, IM, \
     Key, Rating, BlobKey
 
-from .testmodels import FieldsWithoutOptionsModel
+from ..db.db_settings import get_indexes
+from ..db.decoders import get_row_decoder
+from .testmodels import EmailModel, FieldsWithoutOptionsModel
 
 # TODO: Add field conversions for ForeignKeys?
 
@@ -72,4 +74,47 @@ class FieldDBConversionTest(TestCase):
                 types = (types, )
             self.assertTrue(type(getattr(model, name)) in types)
 
+    def test_index_changes(self):
+        # Insert plans are rebuilt when index definitions change.
+        def unindexed_properties(instance):
+            return set(Get(Key.from_path(EmailModel._meta.db_table,
+                instance.pk)).unindexed_properties())
+
+        instance = EmailModel.objects.create(email='rasengan@naruto.com')
+        self.assertEqual(unindexed_properties(instance), set())
+
+        get_indexes()[EmailModel] = {'unindexed': ('email',)}
+        try:
+            instance = EmailModel.objects.create(
+                email='sharingan@uchias.com')
+            self.assertEqual(unindexed_properties(instance),
+                             set(['email']))
+        finally:
+            del get_indexes()[EmailModel]
+
+        instance = EmailModel.objects.create(email='rinnengan@sage.de')
+        self.assertEqual(unindexed_properties(instance), set())
+
+    def test_row_decoder(self):
+        now = datetime.datetime.now()
+        FieldsWithoutOptionsModel.objects.create(
+            datetime=now, date=now.date(), time=now.time(),
+            floating_point=5.97, boolean=True, null_boolean=None,
+            text='Hallo', email='hallo@hallo.com',
+            comma_seperated_integer='5,4,3,2', ip_address='194.167.1.1',
+            slug='you slugy slut :)', url='http://www.scholardocs.com',
+            long_text=1000 * 'A', indexed_text='hello', integer=-400,
+            small_integer=-4, positive_integer=400,
+            positive_small_integer=4)
+        compiler = FieldsWithoutOptionsModel.objects.all().query \
+            .get_compiler('default')
+        fields = compiler.get_fields()
+        entities = list(compiler.build_query(fields).fetch())
+        decoder = get_row_decoder(FieldsWithoutOptionsModel, fields,
+                                  compiler.connection)
+        self.assertEqual(
+            decoder.decode(entities),
+            [tuple(compiler._make_result(entity, fields))
+             for entity in entities])
+
 FieldDBConversionTest = override_settings(USE_TZ=False)(FieldDBConversionTest)
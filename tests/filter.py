@@ -3,7 +3,7 @@ from django.test.utils import override_settings
 import datetime
 import time
 
-from django.db import models
+from django.db import connection, models
 from django.db.models import Q
 from django.db.utils import DatabaseError
 from django.test import TestCase
@@ -11,7 +11,9 @@ from django.utils import unittest
 
 from google.appengine.api.datastore import Get, Key
 
-from ..db.utils import get_cursor, set_cursor
+from ..db.plans import clear_plan_cache, get_plan_cache_stats
+from ..db.utils import get_cursor, set_cursor, set_batch_options, \
+    set_count_shards, delete_entities
 from .testmodels import FieldsWithOptionsModel, EmailModel, DateTimeModel, \
     OrderedModel, BlobModel
 
@@ -219,6 +221,23 @@ class FilterTest(TestCase):
                 .exclude(pk__in=[2, 3]).order_by('pk')],
             [1, 4])
 
+    def test_count(self):
+        self.assertEqual(OrderedModel.objects.exclude(pk__in=[2, 3]).count(),
+                         2)
+        self.assertEqual(OrderedModel.objects.exclude(pk=2)[:2].count(), 2)
+        self.assertTrue(OrderedModel.objects.exclude(pk__in=[2, 3]).exists())
+        self.assertFalse(OrderedModel.objects.exclude(
+            pk__in=[1, 2, 3, 4]).exists())
+        self.assertEqual(FieldsWithOptionsModel.objects.filter(
+            integer__in=[1, 5, 9]).exclude(pk='rasengan@naruto.com').count(),
+            2)
+        self.assertEqual(set_count_shards(
+            FieldsWithOptionsModel.objects.all(), 3).count(), 4)
+
+        # Other options don't leak into fetches.
+        self.assertEqual(len(list(set_count_shards(
+            FieldsWithOptionsModel.objects.all(), 3))), 4)
+
     def test_chained_filter(self):
         # Additionally tests count :)
         self.assertEquals(FieldsWithOptionsModel.objects.filter(
@@ -320,6 +339,49 @@ class FilterTest(TestCase):
         query = set_cursor(FieldsWithOptionsModel.objects.all(), cursor)
         self.assertEqual(list(query[:1]), [])
 
+    def test_batch_options(self):
+        emails = [entity.email for entity in FieldsWithOptionsModel.objects
+                  .order_by('email')]
+        for background_fetch in (True, False):
+            query = set_batch_options(
+                FieldsWithOptionsModel.objects.order_by('email'),
+                batch_size=1, prefetch_size=2,
+                background_fetch=background_fetch)
+            self.assertEqual([entity.email for entity in query], emails)
+            self.assertEqual([entity.email for entity in query[1:3]],
+                             emails[1:3])
+            self.assertEqual(
+                [entity.email for entity in query.iterator()], emails)
+
+        # Options are kept by cloned querysets.
+        query = set_batch_options(FieldsWithOptionsModel.objects.all(),
+                                  batch_size=1)
+        self.assertEqual(query.filter(integer__gt=3).query._gae_config,
+                         {'batch_size': 1})
+
+    def test_batch_options_multiquery(self):
+        # The SDK's MultiQuery is run on its own even with
+        # background_fetch set.
+        connection.settings_dict['CONCURRENT_MULTIQUERY'] = False
+        self.addCleanup(connection.settings_dict.pop,
+                        'CONCURRENT_MULTIQUERY')
+        query = set_batch_options(
+            FieldsWithOptionsModel.objects.filter(integer__in=[1, 5, 9])
+            .order_by('integer'), background_fetch=True)
+        self.assertEqual([entity.integer for entity in query], [1, 5, 9])
+
+    def test_delete_entities(self):
+        query = EmailModel.objects.filter(email__startswith='r')
+        cursor = delete_entities(query, limit=1)
+        self.assertNotEqual(cursor, None)
+        self.assertEqual(query.count(), 1)
+        self.assertEqual(delete_entities(set_cursor(query, cursor)), None)
+        self.assertEqual(query.count(), 0)
+        self.assertEqual(EmailModel.objects.count(), 2)
+
+        EmailModel.objects.all().delete()
+        self.assertEqual(EmailModel.objects.count(), 0)
+
     def test_Q_objects(self):
         self.assertEquals(
             [entity.email for entity in FieldsWithOptionsModel.objects
@@ -346,6 +408,27 @@ class FilterTest(TestCase):
                                    'rasengan@naruto.com'])],
             ['app-engine@scholardocs.com', 'rasengan@naruto.com'])
 
+        # Slices of unordered results skip missing keys.
+        self.assertEquals(
+            [entity.email for entity in FieldsWithOptionsModel.objects
+                .filter(email__in=['app-engine@scholardocs.com',
+                                   'missing@example.com',
+                                   'rasengan@naruto.com',
+                                   'rinnengan@sage.de'])[1:3]],
+            ['rasengan@naruto.com', 'rinnengan@sage.de'])
+
+    def test_pk_in_with_filters(self):
+        self.assertEquals(
+            [entity.email for entity in FieldsWithOptionsModel.objects
+                .filter(email__in=self.emails, integer__gt=2)
+                .exclude(floating_point=9.1)],
+            ['app-engine@scholardocs.com'])
+        self.assertEquals(
+            [entity.email for entity in FieldsWithOptionsModel.objects
+                .filter(Q(integer=1) | Q(integer=2), email__in=self.emails)
+                .order_by('email')],
+            ['rasengan@naruto.com', 'sharingan@uchias.com'])
+
     def test_in(self):
         self.assertEquals(
             [entity.email for entity in FieldsWithOptionsModel.objects
@@ -379,6 +462,28 @@ class FilterTest(TestCase):
         orders = [post.order for post in posts]
         self.assertEqual(orders, range(5, 0, -1))
 
+    def test_in_with_order_by_and_slice(self):
+        self.assertEquals(
+            [entity.email for entity in FieldsWithOptionsModel.objects
+                .filter(integer__in=[1, 2, 5, 9]).order_by('-integer')[1:3]],
+            ['app-engine@scholardocs.com', 'sharingan@uchias.com'])
+        self.assertEquals(
+            FieldsWithOptionsModel.objects
+                .filter(integer__in=[1, 2, 5, 9]).count(), 4)
+
+    def test_in_with_many_values(self):
+
+        class ManyPost(models.Model):
+            writer = models.IntegerField()
+            order = models.IntegerField()
+
+        for writer in range(40):
+            ManyPost(writer=writer, order=40 - writer).save()
+        posts = ManyPost.objects.filter(writer__in=range(35)).order_by('order')
+        self.assertEqual([post.writer for post in posts], range(34, -1, -1))
+        self.assertEqual([post.writer for post in posts[3:6]], [31, 30, 29])
+        self.assertEqual(posts.count(), 35)
+
     def test_inequality(self):
         self.assertEquals(
             [entity.email for entity in FieldsWithOptionsModel.objects
@@ -386,6 +491,10 @@ class FilterTest(TestCase):
             ['rasengan@naruto.com', 'rinnengan@sage.de'])
 
     def test_values(self):
+        # Projection queries have to be enabled (and need indexes).
+        connection.settings_dict['PROJECTION_QUERIES'] = True
+        self.addCleanup(connection.settings_dict.pop, 'PROJECTION_QUERIES')
+
         # Test values().
         self.assertEquals(
             [entity['pk'] for entity in FieldsWithOptionsModel.objects
@@ -395,8 +504,8 @@ class FilterTest(TestCase):
         self.assertEquals(FieldsWithOptionsModel.objects
             .filter(integer__gt=3).order_by('integer').values('pk').count(), 2)
 
-        # These queries first fetch the whole entity and then only
-        # return the desired fields selected in .values.
+        # These queries only fetch the fields selected in .values
+        # (and the ordering properties) using projection queries.
         self.assertEquals(
             [entity['integer'] for entity in FieldsWithOptionsModel.objects
                 .filter(email__startswith='r')
@@ -416,6 +525,55 @@ class FilterTest(TestCase):
                 .filter(integer__gt=3).order_by('integer').values_list('pk')],
             ['app-engine@scholardocs.com', 'rinnengan@sage.de'])
 
+        self.assertEquals(
+            list(FieldsWithOptionsModel.objects.filter(integer__gt=3)
+                .order_by('integer').values_list('integer', 'floating_point')),
+            [(5, 5.3), (9, 9.1)])
+
+        self.assertEquals(
+            list(DateTimeModel.objects.order_by('datetime')
+                .values_list('datetime', flat=True)),
+            FilterTest.datetimes)
+
+        # Fields restricted by equality filters can't be projected.
+        self.assertEquals(
+            list(EmailModel.objects.filter(email='rasengan@naruto.com')
+                .values_list('email', flat=True)),
+            ['rasengan@naruto.com'])
+
+        # Neither can unindexed ones.
+        self.assertEquals(
+            [entity.long_text for entity in FieldsWithOptionsModel.objects
+                .filter(integer__gt=5).only('long_text')],
+            [1000 * 'A'])
+
+        # Test only().
+        self.assertEquals(
+            [(entity.pk, entity.integer)
+             for entity in FieldsWithOptionsModel.objects
+                .filter(integer__lt=3).order_by('integer').only('integer')],
+            [('rasengan@naruto.com', 1), ('sharingan@uchias.com', 2)])
+
+    def test_query_plan_cache(self):
+        clear_plan_cache()
+        for low, integers in ((3, [5, 9]), (5, [9])):
+            self.assertEquals(
+                [entity.integer for entity in FieldsWithOptionsModel.objects
+                    .filter(integer__gt=low).order_by('integer')],
+                integers)
+        stats = get_plan_cache_stats()
+        self.assertEquals((stats['misses'], stats['hits']), (1, 1))
+
+        # __in lookups with a different number of values get another
+        # plan.
+        for values in ([1, 2, 9], [9, 5, 2], [1, 9]):
+            self.assertEquals(
+                [entity.integer for entity in FieldsWithOptionsModel.objects
+                    .filter(integer__in=values).order_by('integer')],
+                sorted(values))
+        stats = get_plan_cache_stats()
+        self.assertEquals((stats['misses'], stats['hits']), (3, 2))
+
     def test_range(self):
         # Test range on float.
         self.assertEquals(
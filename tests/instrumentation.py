@@ -0,0 +1,56 @@
+from django.db import connection
+from django.test import TestCase
+
+from ..db import instrumentation
+from .testmodels import EmailModel
+
+
+class InstrumentationTest(TestCase):
+
+    def setUp(self):
+        self.instances = [EmailModel.objects.create(email=email)
+                          for email in ('app-engine@scholardocs.com',
+                                        'sharingan@uchias.com')]
+
+    def tearDown(self):
+        instrumentation.deactivate()
+
+    def test_request_stats(self):
+        instrumentation.activate()
+        EmailModel.objects.create(email='rasengan@naruto.com')
+        list(EmailModel.objects.filter(
+            pk__in=[instance.pk for instance in self.instances]))
+        list(EmailModel.objects.all().order_by('email'))
+        stats = instrumentation.deactivate()
+
+        summary = stats.summary()
+        self.assertEqual(summary['calls']['Put']['count'], 1)
+        self.assertEqual(summary['calls']['Put']['entities'], 1)
+        self.assertEqual(summary['calls']['Get']['entities'], 2)
+        self.assertEqual(summary['calls']['RunQuery']['entities'], 3)
+        self.assertTrue(summary['calls']['Get']['bytes'] > 0)
+        self.assertEqual(summary['queries'], 3)
+        self.assertEqual(summary['emulated_filters'], 1)
+        self.assertEqual(summary['in_memory_sorts'], 0)
+        self.assertTrue(stats.format().startswith(
+            'rpcs=%d ' % summary['rpcs']))
+        self.assertEqual(instrumentation.get_request_stats(), None)
+
+    def test_query_completed(self):
+        completed = []
+
+        def receiver(sender, operation, in_memory_sort, **kwargs):
+            completed.append((sender, operation, in_memory_sort))
+
+        instrumentation.query_completed.connect(receiver)
+        connection.settings_dict['SLOW_QUERY_THRESHOLD'] = 0
+        try:
+            list(EmailModel.objects.filter(
+                pk__in=[instance.pk for instance in self.instances])
+                .order_by('email'))
+            EmailModel.objects.count()
+        finally:
+            del connection.settings_dict['SLOW_QUERY_THRESHOLD']
+            instrumentation.query_completed.disconnect(receiver)
+        self.assertEqual(completed, [(EmailModel, 'fetch', True),
+                                     (EmailModel, 'count', False)])
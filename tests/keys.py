@@ -257,6 +257,39 @@ class KeysTest(TestCase):
         child = IntegerChild.objects.create(parent=parent)
         self.assertEqual(list(parent.integerchild_set.all()), [child])
 
+    def test_select_related(self):
+        parents = [Parent.objects.create(pk=pk) for pk in (1, 2)]
+        for parent in parents + [parents[0], None]:
+            Child.objects.create(parent=parent)
+        children = list(Child.objects.select_related('parent')
+                        .order_by('pk'))
+        self.assertEqual([child._parent_cache for child in children],
+                         parents + [parents[0], None])
+
+        parent = CharParent.objects.create(id='a')
+        CharChild.objects.create(parent=parent)
+        child = CharChild.objects.select_related().get()
+        self.assertEqual(child._parent_cache, parent)
+
+    def test_prefetch_related(self):
+        parents = [Parent.objects.create(pk=pk) for pk in (1, 2, 3)]
+        for parent in parents + [parents[0], None]:
+            Child.objects.create(parent=parent)
+
+        children = list(Child.objects.prefetch_related('parent')
+                        .order_by('pk'))
+        self.assertEqual([child._parent_cache for child in children],
+                         parents + [parents[0], None])
+
+        parents = list(Parent.objects.prefetch_related('child_set')
+                       .order_by('pk'))
+        self.assertEqual(
+            [sorted(child.parent_id for child in parent.child_set.all())
+             for parent in parents],
+            [[1, 1], [2], [3]])
+        self.assertEqual(
+            len(list(Child.objects.filter(parent__in=[1, 2])[1:])), 2)
+
     @unittest.skipIf(
          not connection.settings_dict.get('STORE_RELATIONS_AS_DB_KEYS'),
          "No key kinds to check with the string/int foreign key storage.")
@@ -60,4 +60,18 @@ class OrderTest(TestCase):
                 OrderedModel.objects.filter(pk__in=pks).order_by()],
             priorities)
 
-    # TODO: Test multiple orders.
+    def test_order_with_pk_filter_and_slice(self):
+        pks, priorities = self.create_ordered_model_items()
+        self.assertEquals(
+            [item.priority for item in
+                OrderedModel.objects.filter(pk__in=pks)[1:3]],
+            sorted(priorities, reverse=True)[1:3])
+
+    def test_multiple_orders_with_pk_filter(self):
+        for pk, priority in enumerate([2, 1, 2, 1]):
+            OrderedModel(pk=pk + 1, priority=priority).save()
+        self.assertEquals(
+            [item.pk for item in
+                OrderedModel.objects.filter(pk__in=[1, 2, 3, 4])
+                    .order_by('priority', '-pk')],
+            [4, 2, 3, 1])
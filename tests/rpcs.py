@@ -0,0 +1,68 @@
+from __future__ import with_statement
+
+from django.test import TestCase
+
+from ..db.utils import update_entities
+from ..db.writes import write_behind
+from ..testing import DatastoreCallsMixin
+from .testmodels import EmailModel
+
+
+class DatastoreCallsTest(DatastoreCallsMixin, TestCase):
+    """
+    Pins numbers of datastore RPCs made by core operations.
+    """
+
+    def setUp(self):
+        self.instances = [EmailModel.objects.create(email=email,
+                                                    number=number)
+                          for email, number in (
+                              ('app-engine@scholardocs.com', 1),
+                              ('sharingan@uchias.com', 2),
+                              ('rinnengan@sage.de', 2))]
+        self.pks = [instance.pk for instance in self.instances]
+
+    def test_create(self):
+        self.assertNumDatastoreCalls({'Put': 1, 'Get': 0},
+                                     EmailModel.objects.create,
+                                     email='rasengan@naruto.com')
+
+    def test_bulk_create(self):
+        with self.assertNumDatastoreCalls(1):
+            EmailModel.objects.bulk_create([
+                EmailModel(email='rasengan@naruto.com') for _ in range(3)])
+
+    def test_write_behind(self):
+        with self.assertNumDatastoreCalls({'AllocateIds': 1, 'Put': 1}):
+            with write_behind():
+                for email in ('rasengan@naruto.com', 'chidori@uchias.com'):
+                    EmailModel.objects.create(email=email)
+
+    def test_pk_lookups(self):
+        with self.assertNumDatastoreCalls(1):
+            EmailModel.objects.get(pk=self.pks[0])
+        with self.assertNumDatastoreCalls(1):
+            list(EmailModel.objects.filter(pk__in=self.pks))
+
+        # Keys are split into chunks of GET_CHUNK_SIZE (100).
+        with self.assertNumDatastoreCalls({'Get': 2, 'RunQuery': 0}):
+            list(EmailModel.objects.filter(pk__in=range(1, 151)))
+
+    def test_queries(self):
+        with self.assertNumDatastoreCalls({'RunQuery': 1, 'Get': 0}):
+            list(EmailModel.objects.filter(number=2))
+
+        # Each __in value needs its own query.
+        with self.assertNumDatastoreCalls({'RunQuery': 2, 'Get': 0}):
+            list(EmailModel.objects.filter(number__in=[1, 2]))
+
+    def test_delete(self):
+        with self.assertNumDatastoreCalls({'Get': 1, 'Delete': 1}):
+            EmailModel.objects.filter(pk__in=self.pks).delete()
+
+    def test_update(self):
+        # Entities returned by the query are updated without Gets.
+        with self.assertNumDatastoreCalls({'RunQuery': 1, 'Get': 0,
+                                           'Put': 1}):
+            update_entities(EmailModel.objects.filter(number=2),
+                            {'number': 3}, transactional=False)
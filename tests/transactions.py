@@ -1,6 +1,7 @@
 from django.db.models import F
 from django.test import TestCase
 
+from ..db.utils import set_batch_options, update_entities
 from .testmodels import EmailModel
 
 
@@ -28,6 +29,43 @@ class TransactionTest(TestCase):
         self.assertEqual(3, len(EmailModel.objects.all().filter(
             email=self.emails[1])))
 
+    def test_update_entities(self):
+        self.assertEqual(
+            update_entities(EmailModel.objects.filter(email=self.emails[0]),
+                            {'number': 5}),
+            {'updated': 2, 'skipped': 0, 'retried': 0})
+
+        stats = update_entities(EmailModel.objects.filter(number=5),
+                                {'number': F('number') + 1},
+                                transactional=False)
+        self.assertEqual(stats['updated'], 2)
+        self.assertEqual(2, len(EmailModel.objects.all().filter(number=6)))
+
+        self.assertEqual(1, EmailModel.objects.all().filter(
+            email=self.emails[1]).update(number=7))
+
+        # Entities got for a primary key lookup are checked against
+        # other filters, skipping ones that don't match.
+        pks = EmailModel.objects.values_list('pk', flat=True)
+        self.assertEqual(
+            update_entities(EmailModel.objects.filter(pk__in=list(pks),
+                                                      number=6),
+                            {'number': F('number') * 2},
+                            transactional=False),
+            {'updated': 2, 'skipped': 1, 'retried': 0})
+        self.assertEqual(2, len(EmailModel.objects.all().filter(number=12)))
+
+        # Entities moved forward in the scanned index are only updated
+        # once.
+        stats = update_entities(
+            set_batch_options(EmailModel.objects.filter(number__gt=0)
+                              .order_by('number'), batch_size=1),
+            {'number': F('number') + 100}, transactional=False)
+        self.assertEqual(stats['updated'], 3)
+        self.assertEqual(
+            sorted(EmailModel.objects.values_list('number', flat=True)),
+            [107, 112, 112])
+
     def test_f_object_updates(self):
         self.assertEqual(1, len(EmailModel.objects.all().filter(
             number=1)))
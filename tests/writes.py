@@ -0,0 +1,137 @@
+from __future__ import with_statement
+
+from django.db.utils import DatabaseError
+from django.test import TestCase
+
+from google.appengine.api.datastore import Get, Key, RunInTransaction
+
+from ..db.utils import allocate_ids, commit_locked
+from ..db.writes import get_write_buffer, write_behind
+from ..fields import AncestorKey
+from ..utils import bulk_create
+from .ancestor import AncestorModel, ChildModel
+from .testmodels import EmailModel
+
+
+class WriteBehindTest(TestCase):
+
+    def _stored(self, instances):
+        return Get([Key.from_path(EmailModel._meta.db_table, instance.pk)
+                    for instance in instances])
+
+    def test_buffered_saves(self):
+        with write_behind():
+            instances = [EmailModel.objects.create(email=email)
+                         for email in ('app-engine@scholardocs.com',
+                                       'sharingan@uchias.com')]
+            self.assertTrue(all(instance.pk for instance in instances))
+            self.assertEqual(self._stored(instances), [None, None])
+
+            # Buffered entities can be fetched by primary key.
+            self.assertEqual(
+                EmailModel.objects.get(pk=instances[0].pk).email,
+                'app-engine@scholardocs.com')
+
+            instances[0].email = 'rasengan@naruto.com'
+            instances[0].save()
+
+        self.assertEqual([entity['email']
+                          for entity in self._stored(instances)],
+                         ['rasengan@naruto.com', 'sharingan@uchias.com'])
+        self.assertEqual(get_write_buffer(), None)
+        self.assertNotIn(EmailModel._meta.pk.column,
+                         self._stored(instances)[0])
+
+    def test_updates_flush(self):
+        with write_behind():
+            instance = EmailModel.objects.create(email='rinnengan@sage.de',
+                                                 number=1)
+            EmailModel.objects.filter(pk=instance.pk).update(number=2)
+        self.assertEqual(EmailModel.objects.get(pk=instance.pk).number, 2)
+
+    def test_deletes_flush(self):
+        with write_behind():
+            EmailModel.objects.create(email='rinnengan@sage.de', number=1)
+            EmailModel.objects.filter(number=1).delete()
+        self.assertEqual(EmailModel.objects.count(), 0)
+
+    def test_transactional_saves(self):
+        # Saves made in a transaction aren't overwritten by buffered
+        # entities.
+        with write_behind():
+            instance = EmailModel.objects.create(email='rinnengan@sage.de',
+                                                 number=1)
+
+            def save():
+                instance.number = 2
+                instance.save()
+            RunInTransaction(save)
+        self.assertEqual(EmailModel.objects.get(pk=instance.pk).number, 2)
+
+    def test_transactions_flush(self):
+        # Buffered entities are put before commit_locked transactions.
+        with write_behind():
+            instance = EmailModel.objects.create(email='rinnengan@sage.de')
+            commit_locked(
+                EmailModel.objects.filter(pk=instance.pk).delete)()
+        self.assertEqual(EmailModel.objects.count(), 0)
+
+        # Other transactions can't put them.
+        stored = EmailModel.objects.create(email='rasengan@naruto.com')
+        with write_behind():
+            EmailModel.objects.create(email='sharingan@uchias.com')
+            self.assertRaises(
+                DatabaseError, RunInTransaction,
+                EmailModel.objects.filter(pk=stored.pk).delete)
+        self.assertEqual(EmailModel.objects.count(), 2)
+
+    def test_errors_flush(self):
+        def save_and_fail():
+            with write_behind():
+                EmailModel.objects.create(email='rasengan@naruto.com')
+                raise ValueError()
+
+        self.assertRaises(ValueError, save_and_fail)
+        self.assertEqual(EmailModel.objects.count(), 1)
+
+
+class BulkCreateTest(TestCase):
+    emails = ['app-engine@scholardocs.com', 'sharingan@uchias.com',
+              'rinnengan@sage.de', 'rasengan@naruto.com']
+
+    def test_bulk_create(self):
+        for allocate in (False, True):
+            instances = bulk_create(
+                (EmailModel(email=email) for email in self.emails),
+                batch_size=3, allocate_ids=allocate)
+            self.assertEqual(
+                [EmailModel.objects.get(pk=instance.pk).email
+                 for instance in instances],
+                self.emails)
+        self.assertEqual(EmailModel.objects.count(), 8)
+
+    def test_ancestors(self):
+        parent = AncestorModel.objects.create()
+        children = bulk_create(
+            [ChildModel(id=AncestorKey(parent)) for _ in range(3)],
+            batch_size=2, allocate_ids=True)
+        self.assertTrue(all(child.pk.key_id for child in children))
+        self.assertEqual(ChildModel.descendents_of(parent).count(), 3)
+
+    def test_queryset_bulk_create(self):
+        instances = [EmailModel(email=email) for email in self.emails]
+        EmailModel.objects.bulk_create(instances)
+        self.assertEqual(
+            sorted(EmailModel.objects.values_list('pk', flat=True)),
+            sorted(instance.pk for instance in instances))
+
+    def test_allocate_ids(self):
+        pks = allocate_ids(EmailModel, 2)
+        self.assertEqual(len(set(pks)), 2)
+        EmailModel.objects.create(pk=pks[1], email=self.emails[0])
+        self.assertEqual(EmailModel.objects.get().pk, pks[1])
+
+        parent = AncestorModel.objects.create()
+        child = ChildModel.objects.create(
+            id=allocate_ids(ChildModel, 1, ancestor=parent)[0])
+        self.assertEqual(ChildModel.descendents_of(parent).get(), child)
@@ -2,7 +2,7 @@ import os
 
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api.app_identity import get_application_id
-from google.appengine.api.datastore import Entity, Put
+from google.appengine.api.datastore import Entity, PutAsync
 
 have_appserver = bool(apiproxy_stub_map.apiproxy.GetStub('datastore_v3'))
 
@@ -24,24 +24,66 @@ def appid():
 on_production_server = 'SERVER_SOFTWARE' in os.environ and not os.environ['SERVER_SOFTWARE'].startswith("Development")
 
 
-def bulk_create(instances, connection=None):
+def bulk_create(instances, connection=None, batch_size=None,
+                allocate_ids=False):
     """
         Uses AppEngine's bulk Put() call on a number of instances
         this will NOT call save() but it will return the instances
         with their primary_key populated (unlike Django's bulk_create)
+
+        Instances are converted and put in chunks of batch_size (the
+        PUT_CHUNK_SIZE database option by default), with several Put
+        RPCs in flight at a time. With allocate_ids, ids of each chunk
+        are reserved (using AllocateIds) and set on the instances
+        before the chunk is put.
     """
     if connection is None:
         from django.db import connection
 
+    from .db.batch import allocate_keys, chunked, run_concurrently, \
+        DEFAULT_MAX_CONCURRENT_RPCS, DEFAULT_PUT_CHUNK_SIZE
     from .fields import AncestorKey
 
-    def prepare_entity(instance):
+    settings_dict = connection.settings_dict
+    if batch_size is None:
+        batch_size = settings_dict.get('PUT_CHUNK_SIZE',
+                                       DEFAULT_PUT_CHUNK_SIZE)
+    max_in_flight = settings_dict.get('MAX_CONCURRENT_RPCS',
+                                      DEFAULT_MAX_CONCURRENT_RPCS)
+
+    def get_parent(instance):
         if isinstance(instance.pk, AncestorKey):
-            parent = instance.pk._parent_key
+            return instance.pk._parent_key
+        return None
+
+    def set_key(instance, key):
+        if key.parent():
+            instance._parent_key = key.parent()
+            instance.pk.key_id = key.id_or_name()
         else:
-            parent = None
+            instance.id = key.id_or_name()
+
+    def allocate(chunk):
+        groups = {}
+        for instance in chunk:
+            group = (instance._meta.db_table, get_parent(instance))
+            groups.setdefault(group, []).append(instance)
+        for (kind, parent), group in groups.items():
+            for instance, key in zip(group, allocate_keys(
+                    kind, len(group), parent)):
+                set_key(instance, key)
 
-        result = Entity(instance._meta.db_table, parent=parent)
+    def prepare_entity(instance):
+        parent = get_parent(instance)
+        if allocate_ids:
+            if parent is None:
+                key_id = instance.id
+            else:
+                key_id = instance.pk.key_id
+            result = Entity(instance._meta.db_table, parent=parent,
+                            id=key_id)
+        else:
+            result = Entity(instance._meta.db_table, parent=parent)
 
         for field in instance._meta.fields:
             if field.name == "id":
@@ -58,20 +100,23 @@ def bulk_create(instances, connection=None):
             result[field.column] = value
         return result
 
-    entities = [ prepare_entity(x) for x in instances ]
-
-    keys = Put(entities)
-
-    assert(len(keys) == len(entities))
+    def prepare_chunks():
+        for chunk in chunked(instances, batch_size):
+            if allocate_ids:
+                allocate(chunk)
+            yield chunk, [prepare_entity(x) for x in chunk]
 
-    for i, key in enumerate(keys):
-        assert(key)
+    def put_chunk(chunk):
+        return PutAsync(chunk[1])
 
-        if key.parent():
-            instances[i]._parent_key = key.parent()
-            instances[i].pk.key_id = key.id_or_name()
-        else:
-            instances[i].id = key.id_or_name()
+    result = []
+    for (chunk, entities), keys in run_concurrently(
+            put_chunk, prepare_chunks(), max_in_flight):
+        assert(len(keys) == len(entities))
 
-    return instances
+        for instance, key in zip(chunk, keys):
+            assert(key)
+            set_key(instance, key)
+        result.extend(chunk)
 
+    return result